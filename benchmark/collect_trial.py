@@ -0,0 +1,47 @@
+'''
+Compares the onset overhead of starting a trial the usual way
+(flush_serial_buffer(), clear_response_queue() and reset_timer(), each its
+own driver call) with collect_trial(), which purges and resets the timer in
+one step. Each trial uses a short window and collects no responses, so
+only the start of the trial is measured.
+'''
+import time
+
+import pyxid2
+
+TRIALS = 200
+WINDOW_MS = 1
+
+
+def summary(times):
+    times.sort()
+    return "min %.3f  median %.3f  p95 %.3f  max %.3f ms" % (
+        times[0], times[len(times) // 2], times[int(len(times) * 0.95)],
+        times[-1])
+
+
+devices = pyxid2.get_xid_devices()
+
+if not devices:
+    print("No XID devices detected")
+    exit()
+
+dev = devices[0]
+print("Using ", dev)
+
+separate = []
+for i in range(TRIALS):
+    start = time.perf_counter()
+    dev.flush_serial_buffer()
+    dev.clear_response_queue()
+    dev.reset_timer()
+    separate.append((time.perf_counter() - start) * 1000.0)
+    dev.wait_for_response(WINDOW_MS)
+
+armed = []
+for i in range(TRIALS):
+    result = dev.collect_trial(WINDOW_MS)
+    armed.append(result['onset_overhead_ms'])
+
+print("flush + clear + reset_timer: " + summary(separate))
+print("collect_trial():             " + summary(armed))
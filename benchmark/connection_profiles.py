@@ -0,0 +1,46 @@
+'''
+Reports the command round-trip time of the first XID device under each
+connection profile.
+
+A short reply from the device sits in the FTDI chip until its latency timer
+expires, the same as a response packet does, so the round-trip of a one byte
+query ('_d2') tracks the end-to-end delay added to every response by the
+profile's latency timer.
+'''
+import time
+
+import pyxid2
+
+ROUND_TRIPS = 200
+
+
+def round_trips(dev, count):
+    times = []
+    for i in range(count):
+        start = time.perf_counter()
+        dev.con.send_xid_command('_d2', 1)
+        times.append((time.perf_counter() - start) * 1000.0)
+    times.sort()
+    return times
+
+
+devices = pyxid2.get_xid_devices()
+
+if not devices:
+    print("No XID devices detected")
+    exit()
+
+dev = devices[0]
+print("Using ", dev)
+
+for name in sorted(pyxid2.CONNECTION_PROFILES):
+    dev.con.set_profile(name)
+    dev.flush_serial_buffer()
+    times = round_trips(dev, ROUND_TRIPS)
+    print("%-12s latency timer %2d ms: round-trip min %.2f  median %.2f  "
+          "p95 %.2f  max %.2f ms" % (
+              name, dev.con.profile.latency_timer, times[0],
+              times[len(times) // 2], times[int(len(times) * 0.95)],
+              times[-1]))
+
+dev.con.set_profile(pyxid2.BALANCED_PROFILE)
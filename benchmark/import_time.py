@@ -0,0 +1,44 @@
+'''
+Measures how long "import pyxid2" takes in a fresh interpreter and checks
+that importing it does not load the ftd2xx driver bindings; those are only
+loaded when devices are scanned for or opened.
+
+Exits with status 1 if the import is slower than the budget (in ms, the
+first argument, default 50) or ftd2xx was imported.
+'''
+import subprocess
+import sys
+
+BUDGET_MS = float(sys.argv[1]) if len(sys.argv) > 1 else 50.0
+RUNS = 5
+
+CHECK = "import sys, pyxid2; print('ftd2xx' in sys.modules)"
+
+
+def import_time_ms():
+    # -X importtime writes "self [us] | cumulative [us] | package" to stderr
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', CHECK],
+                            capture_output=True, text=True, check=True)
+    cumulative = None
+    for line in result.stderr.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == 'pyxid2':
+            cumulative = int(fields[1]) / 1000.0
+    return (cumulative, result.stdout.strip() == 'True')
+
+
+times = []
+ftd2xx_loaded = False
+for i in range(RUNS):
+    (ms, loaded) = import_time_ms()
+    times.append(ms)
+    ftd2xx_loaded = ftd2xx_loaded or loaded
+times.sort()
+
+print("import pyxid2: min %.1f  median %.1f  max %.1f ms (budget %.1f ms)" % (
+    times[0], times[len(times) // 2], times[-1], BUDGET_MS))
+print("ftd2xx loaded by import: %s" % ftd2xx_loaded)
+
+if ftd2xx_loaded or times[len(times) // 2] > BUDGET_MS:
+    print("FAILED")
+    sys.exit(1)
@@ -0,0 +1,43 @@
+'''
+Measures how long it takes to bring up XID devices: the scan, and for
+each device the time from opening its connection until it is identified
+and initialized (XidDevice constructed, output lines cleared, timer reset).
+'''
+import time
+
+import pyxid2
+
+RUNS = 5
+
+scan_times = []
+for i in range(RUNS):
+    start = time.perf_counter()
+    pyxid2.scanner.detect_xid_devices()
+    scan_times.append((time.perf_counter() - start) * 1000.0)
+
+if pyxid2.scanner.device_count() == 0:
+    print("No XID devices detected")
+    exit()
+
+print("scan: min %.1f  median %.1f  max %.1f ms" % (
+    min(scan_times), sorted(scan_times)[RUNS // 2], max(scan_times)))
+
+init_commands = pyxid2.DEFAULT_INIT_COMMANDS + (pyxid2.INIT_RESET_TIMER,)
+
+for i in range(pyxid2.scanner.device_count()):
+    com = pyxid2.scanner.device_at_index(i)
+    ready_times = []
+    for run in range(RUNS):
+        start = time.perf_counter()
+        com.open()
+        dev = pyxid2.XidDevice(com, init_commands)
+        ready_times.append((time.perf_counter() - start) * 1000.0)
+        com.close()
+    ready_times.sort()
+    print("%-28s time to ready: min %.1f  median %.1f  max %.1f ms" % (
+        dev, ready_times[0], ready_times[RUNS // 2], ready_times[-1]))
+
+start = time.perf_counter()
+devices = pyxid2.get_xid_devices(incremental=True)
+print("get_xid_devices(incremental=True) for %d devices: %.1f ms" % (
+    len(devices), (time.perf_counter() - start) * 1000.0))
@@ -0,0 +1,77 @@
+'''
+Compares the documented spin loop (has_response()/poll_for_response()) with
+wait_for_response() for CPU use and detection latency, the latter in each
+io mode the connection supports on this machine.
+
+Press and release a key on the device repeatedly while each method runs.
+Detection latency is the host time at which a response is handed to the
+caller minus its device timestamp, both counted from reset_timer(). Only the
+spread of the latency is meaningful, since the reset itself has a small
+unknown offset.
+'''
+import time
+
+import pyxid2
+
+RESPONSES_PER_METHOD = 20
+TIMEOUT_MS = 10000
+
+
+def spin_loop(dev, deadline):
+    while not dev.has_response():
+        if time.perf_counter() > deadline:
+            return None
+        dev.poll_for_response()
+    return dev.get_next_response()
+
+
+def blocking_wait(dev, deadline):
+    return dev.wait_for_response(deadline=deadline)
+
+
+def measure(dev, name, collect):
+    print("%s: press a key %d times" % (name, RESPONSES_PER_METHOD // 2))
+    dev.flush_serial_buffer()
+    dev.clear_response_queue()
+    dev.reset_timer()
+    host_zero = time.perf_counter()
+
+    latencies = []
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    while len(latencies) < RESPONSES_PER_METHOD:
+        response = collect(dev, time.perf_counter() + TIMEOUT_MS / 1000.0)
+        if response is None:
+            break
+        host_ms = (time.perf_counter() - host_zero) * 1000.0
+        latencies.append(host_ms - response['time'])
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    if not latencies:
+        print("  no responses")
+        return
+
+    latencies.sort()
+    print("  responses:        %d" % len(latencies))
+    print("  CPU use:          %.1f%%" % (100.0 * cpu / wall))
+    print("  latency min/median/max: %.2f / %.2f / %.2f ms" % (
+        latencies[0], latencies[len(latencies) // 2], latencies[-1]))
+
+
+devices = pyxid2.get_xid_devices()
+
+if not devices:
+    print("No XID devices detected")
+    exit()
+
+dev = devices[0]
+print("Using ", dev)
+
+measure(dev, "spin loop", spin_loop)
+for io_mode in (pyxid2.IO_MODE_TIMEOUT, pyxid2.IO_MODE_QUEUE,
+                pyxid2.IO_MODE_EVENT):
+    if dev.con.set_io_mode(io_mode) == io_mode:
+        measure(dev, "wait_for_response (%s io mode)" % io_mode,
+                blocking_wait)
+dev.con.set_io_mode(pyxid2.IO_MODE_TIMEOUT)
@@ -2,27 +2,133 @@
 
 from .pyxid_impl import *  # noqa
 
+import threading
+
+from .registry import DeviceRegistry
+
 scanner = XidScanner()
+# The open XidDevices of this process, by serial number and USB location
+registry = DeviceRegistry()
+
+def _open_device(com, profile, init_commands):
+    com.set_profile(profile)
+    if com.open():
+        return XidDevice(com, init_commands)
+
+    return None
+
+# Held from detection through registration, so concurrent scans don't
+# close and reopen each other's connections
+_scan_lock = threading.Lock()
+
+def _scan(profile, incremental, baud_rate, init_commands):
+    # Called with _scan_lock held. Returns the devices found, registered
+    # but not acquired.
+    if init_commands is None:
+        init_commands = DEFAULT_INIT_COMMANDS + (INIT_RESET_TIMER,)
+
+    if incremental is None:
+        incremental = len(registry.devices()) > 0
+
+    if not incremental:
+        # A full rescan closes every connection, whoever holds the device
+        registry.close_all()
+
+    scanner.detect_xid_devices(incremental, baud_rate)
+
+    coms = [scanner.device_at_index(i) for i in range(scanner.device_count())]
+    devices = [None] * len(coms)
+    errors = []
+
+    def bring_up(i):
+        try:
+            devices[i] = _open_device(coms[i], profile, init_commands)
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = []
+    for i in range(len(coms)):
+        device = registry.lookup_connection(coms[i]) if incremental else None
+        if device is not None:
+            devices[i] = device
+            continue
+
+        thread = threading.Thread(target=bring_up, args=(i,))
+        thread.start()
+        threads.append(thread)
 
-def get_xid_devices():
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    devices = [device for device in devices if device is not None]
+    for device in devices:
+        registry.register(device)
+
+    return devices
+
+def get_xid_devices(profile=None, incremental=None, baud_rate=None,
+                    init_commands=None):
     """
     Returns a list of all Xid devices connected to your computer.
+
+    profile selects the FTDI driver settings used for the connections:
+    'low_latency', 'balanced' (the default) or 'throughput', or a
+    ConnectionProfile. See CONNECTION_PROFILES.
+
+    With incremental=True only newly attached FTDI devices are probed.
+    Devices returned by an earlier call that are still attached are
+    returned again as they are (their profile is not changed) instead of
+    being closed and reinitialized. This is the default once devices are
+    open, so repeated calls (from different parts of a program, say) share
+    the devices instead of closing each other's handles; pass
+    incremental=False to force a full rescan, which closes and reopens
+    every device.
+
+    A reference is counted to each device returned, as by
+    open_xid_device(): the caller must close() every device it gets (or
+    use it in a with block) when done with it, and a shared device is only
+    closed once every caller has.
+
+    If all devices are known to use the same baud_rate, pass it to skip
+    trying the other rates.
+
+    init_commands are the INIT_* commands sent to each device once it has
+    been identified, by default all of them (which resets the timer).
+    Devices are opened and initialized in parallel.
     """
-    devices = []
+    with _scan_lock:
+        devices = _scan(profile, incremental, baud_rate, init_commands)
+        return [registry.acquire(device) for device in devices]
 
-    scanner.detect_xid_devices()
+def open_xid_device(serial=None, location=None, profile=None):
+    """
+    Returns the XidDevice with the given FTDI serial number or USB location
+    (see XidConnection.serial and .location), the one already open in this
+    process if there is one, otherwise opened with get_xid_devices(profile,
+    incremental=True).
 
-    for i in range(scanner.device_count()):
-        com = scanner.device_at_index(i)
-        if com.open():
-            device = XidDevice(com)
+    The caller holds a reference to the device until it calls
+    device.close(), or until the end of a with block using the device; the
+    device is closed when the last reference is given up. Raises XidError
+    if no such device is attached.
+    """
+    with _scan_lock:
+        device = registry.lookup(serial, location)
+        if device is None:
+            # Held until the device is acquired: devices nobody holds are
+            # closed
+            devices = _scan(profile, True, None, None)
+            device = registry.lookup(serial, location)
 
-            device.reset_timer()
+        if device is None:
+            raise XidError('No XID device with %s %r was found' % (
+                ('serial number', serial) if serial else
+                ('location', location)))
 
-            devices.append(device)
-        else:
-            continue
-    return devices
+        return registry.acquire(device)
 
 def get_xid_device(device_number):
     print("The function get_xid_device() was removed in pyxid2 version 1.0.7. Use get_xid_devices() instead. Refer to https://github.com/cedrus-opensource/pyxid/tree/master/sample for usage examples.")
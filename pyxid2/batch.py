@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+from . import commands
+from .internal import XidError
+
+
+class CommandBatch(object):
+    """
+    Queues set and query commands for an XidDevice and sends them together.
+
+    Each command normally costs its own USB write, and each query its own
+    write-then-read round-trip. A batch writes all queued commands back to
+    back, reads the combined replies in a single read and splits them by
+    each query's reply length, so configuring a device takes a couple of
+    round-trips regardless of how many settings are involved.
+
+    The set and get methods mirror those of XidDevice, including returning
+    None for queries an XID 1 device does not support. execute() returns
+    the query results in the order the queries were queued.
+
+    Example:
+        batch = dev.command_batch()
+        batch.set_signal_filter('K', 100, 200)
+        batch.set_enable_usb_output('K', True)
+        batch.get_signal_filter('K')
+        batch.get_pulse_duration()
+        (signal_filter, duration) = batch.execute()
+
+    A batch can also be used as a context manager, in which case it is
+    executed when the block ends and the results are kept in `results`.
+    """
+    def __init__(self, device):
+        self._device = device
+        self._entries = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _xid2(self):
+        return self._device.major_fw_version > 1
+
+    def send(self, command, setting=None, value=None):
+        """
+        Queues a command that has no reply. command is a str or bytes.
+        If setting is given, the device's settings cache is updated with
+        value once the batch has been sent.
+        """
+        if not isinstance(command, bytes):
+            command = command.encode('latin1')
+
+        self._entries.append((command, None, setting, value))
+
+    def query(self, query, setting=None):
+        """
+        Queues a commands.Query. Its decoded reply is part of the results,
+        and is stored in the device's settings cache if setting is given.
+        """
+        self._entries.append((query.command, query, setting, None))
+
+    def _unsupported_query(self, result=None):
+        # Not sent; result stands in for the reply, as in XidDevice
+        self._entries.append((None, None, None, result))
+
+    def execute(self):
+        """
+        Sends the queued commands and returns the decoded query results.
+        The batch is empty afterwards and can be reused.
+        """
+        entries = self._entries
+        self._entries = []
+
+        sent = [(command, query.bytes_expected if query is not None else 0)
+                for (command, query, _, _) in entries if command is not None]
+        replies = iter(self._device.con.send_xid_commands(sent)
+                       if sent else [])
+
+        cache = self._device.settings_cache
+        results = []
+        for (command, query, setting, value) in entries:
+            if command is None:
+                results.append(value)
+                continue
+
+            reply = next(replies)
+            if query is not None:
+                if len(reply) < query.bytes_expected:
+                    raise XidError('No reply to %r from %s' % (
+                        command, self._device.device_name))
+                value = query.decode(reply)
+                results.append(value)
+            if setting is not None:
+                cache.put(setting, value)
+
+        self.results = results
+
+        return results
+
+    def set_pulse_duration(self, duration):
+        self.send(commands.pulse_duration_command(duration),
+                  'pulse_duration', duration)
+
+    def get_pulse_duration(self):
+        self.query(commands.pulse_duration_query(), 'pulse_duration')
+
+    def set_single_shot(self, selector, action, delay):
+        self.send(commands.single_shot_command(selector, action, delay),
+                  ('single_shot', selector), (action is True, delay))
+
+    def get_single_shot(self, selector):
+        if self._xid2():
+            self.query(commands.single_shot_query(selector),
+                       ('single_shot', selector))
+        else:
+            self._unsupported_query()
+
+    def set_signal_filter(self, selector, holdOn, holdOff):
+        if self._xid2():
+            self.send(commands.signal_filter_command(selector, holdOn,
+                                                     holdOff),
+                      ('signal_filter', selector), (holdOn, holdOff))
+
+    def get_signal_filter(self, selector):
+        if self._xid2():
+            self.query(commands.signal_filter_query(selector),
+                       ('signal_filter', selector))
+        else:
+            self._unsupported_query()
+
+    def set_enable_digital_output(self, selector, enable):
+        if self._xid2():
+            self.send(commands.enable_digital_output_command(selector,
+                                                             enable),
+                      ('digital_output', selector), enable is True)
+
+    def get_enable_digital_output(self, selector):
+        if self._xid2():
+            self.query(commands.enable_digital_output_query(selector),
+                       ('digital_output', selector))
+        else:
+            self._unsupported_query()
+
+    def set_enable_usb_output(self, selector, enable):
+        if self._xid2():
+            self.send(commands.enable_usb_output_command(selector, enable),
+                      ('usb_output', selector), enable is True)
+
+    def get_enable_usb_output(self, selector):
+        if self._xid2():
+            self.query(commands.enable_usb_output_query(selector),
+                       ('usb_output', selector))
+        else:
+            self._unsupported_query()
+
+    def pause_output(self, pause):
+        if self._xid2():
+            self.send(commands.pause_output_command(pause),
+                      'input_paused', pause is True)
+
+    def is_input_paused(self):
+        if self._xid2():
+            self.query(commands.input_paused_query(), 'input_paused')
+        else:
+            self._unsupported_query()
+
+    def set_pulse_table_bitmask(self, mask):
+        if self._xid2():
+            self.send(commands.pulse_table_bitmask_command(mask),
+                      'pulse_table_bitmask', mask)
+
+    def get_pulse_table_bitmask(self):
+        if self._xid2():
+            self.query(commands.pulse_table_bitmask_query(),
+                       'pulse_table_bitmask')
+        else:
+            self._unsupported_query(0)
+
+    def add_pulse_table_entry(self, time, mask):
+        if self._xid2():
+            self.send(commands.pulse_table_entry_command(time, mask))
+
+    def clear_pulse_table(self):
+        if self._xid2():
+            self.send('mc')
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Marker-to-input loopback latency calibration.
+
+Needs a device whose output lines are wired back to one of its inputs,
+e.g. a StimTracker Duo/Quad with an output connected to an input, or a
+response pad with an output looped back. Each marker is sent with the host
+time noted; the device timestamps the input it causes, so the difference
+between the two (on a common time base set up by reset_timer()) is the
+end-to-end latency of raising a line.
+
+Example:
+    dev = pyxid2.get_xid_devices('low_latency')[0]
+    result = calibrate_marker_latency(dev, count=2000)
+    print(result.summary())
+    result.save('rig1_low_latency.json')
+"""
+import json
+import time
+
+
+class CalibrationResult(object):
+    """
+    Latencies measured by calibrate_marker_latency(), all in miliseconds:
+
+        latencies:   device timestamp of the looped back input minus the
+                     host time the marker was sent.
+        round_trips: host time the input was parsed minus the host time
+                     the marker was sent.
+
+    lost counts markers whose input never arrived.
+
+    offset_ms is the median time from writing a marker to the device
+    timestamping the input it causes: what should be subtracted from device
+    timestamps of markers, or added to marker send times, to line the two
+    up. It relies on the host and device clocks having been lined up with
+    sync_device_clock(), to within info['clock_error_ms']. XID 1 devices
+    have no timer query, so their latencies are measured from a timer reset
+    that travelled as slowly as the markers and come out near 0; for them
+    (info['clock_sync'] == 'reset_timer') offset_ms is half the median
+    round-trip instead, a rough upper bound.
+    """
+    def __init__(self, latencies, round_trips, lost=0, info=None):
+        self.latencies = list(latencies)
+        self.round_trips = list(round_trips)
+        self.lost = lost
+        self.info = dict(info or {})
+
+    @property
+    def offset_ms(self):
+        if self.info.get('clock_sync') != 'timer_query':
+            median = self.stats(self.round_trips)['median']
+            return median / 2.0 if median is not None else None
+
+        return self.stats()['median']
+
+    def stats(self, values=None):
+        """
+        Returns a dict of 'count', 'min', 'median', 'mean', 'p95', 'p99',
+        'max' and 'jitter' (standard deviation) of values, the latencies
+        by default.
+        """
+        values = sorted(self.latencies if values is None else values)
+        count = len(values)
+        if count == 0:
+            return {'count': 0, 'min': None, 'median': None, 'mean': None,
+                    'p95': None, 'p99': None, 'max': None, 'jitter': None}
+
+        mean = sum(values) / float(count)
+        variance = sum((v - mean) ** 2 for v in values) / float(count)
+
+        return {'count': count,
+                'min': values[0],
+                'median': values[count // 2],
+                'mean': mean,
+                'p95': values[min(count - 1, int(count * 0.95))],
+                'p99': values[min(count - 1, int(count * 0.99))],
+                'max': values[-1],
+                'jitter': variance ** 0.5}
+
+    def summary(self):
+        latency = self.stats()
+        round_trip = self.stats(self.round_trips)
+        if latency['count'] == 0:
+            return 'No markers came back (%d lost)' % self.lost
+
+        return ('%d markers, %d lost\n'
+                'latency:    median %.2f  mean %.2f  p95 %.2f  p99 %.2f  '
+                'max %.2f  jitter %.2f ms\n'
+                'round-trip: median %.2f  p95 %.2f  max %.2f ms' % (
+                    latency['count'], self.lost, latency['median'],
+                    latency['mean'], latency['p95'], latency['p99'],
+                    latency['max'], latency['jitter'],
+                    round_trip['median'], round_trip['p95'],
+                    round_trip['max']))
+
+    def to_dict(self):
+        return {'offset_ms': self.offset_ms,
+                'latency': self.stats(),
+                'round_trip': self.stats(self.round_trips),
+                'lost': self.lost,
+                'info': self.info,
+                'latencies': self.latencies,
+                'round_trips': self.round_trips}
+
+    def save(self, path):
+        """
+        Writes the result to path as JSON
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+
+        return cls(data['latencies'], data['round_trips'], data['lost'],
+                   data['info'])
+
+
+def sync_device_clock(device, samples=5):
+    """
+    Lines up the device's timer with the host's time.perf_counter() clock
+    by querying the timer samples times. Each timer value is taken to have
+    been read halfway through its query's round-trip, and the sample with
+    the shortest round-trip is used.
+
+    Returns (timer_zero, error_ms): the perf_counter() time at which the
+    device's timer read 0, and half the round-trip used, which bounds the
+    error. Returns None for XID 1 devices, whose timer can't be queried.
+    """
+    if device.major_fw_version < 2:
+        return None
+
+    best = None
+    for i in range(samples):
+        before = time.perf_counter()
+        device_time = device.query_timer()
+        after = time.perf_counter()
+        if best is None or after - before < best[0]:
+            # The timer counts whole miliseconds, so it read device_time
+            # for a milisecond
+            best = (after - before,
+                    (before + after) / 2.0 - (device_time + 0.5) / 1000.0)
+
+    return (best[1], best[0] * 500.0)
+
+
+def calibrate_marker_latency(device, count=1000, lines=1, port=None,
+                             use_mask=False, interval=0.005, timeout=100):
+    """
+    Sends count markers on the given output lines (a bitmask) and matches
+    each one to the input it causes, the next key press from port (any
+    port if None). Markers are raised with set_digital_output_lines(), or
+    set_digio_lines_to_mask() if use_mask is True, and lowered again after
+    their input arrived or timeout miliseconds passed. interval seconds are
+    left between markers.
+
+    This resets the device's timer and clears the response queue.
+    Returns a CalibrationResult.
+    """
+    con = device.con
+
+    def raise_lines(mask):
+        if use_mask:
+            con.set_digio_lines_to_mask(mask)
+        else:
+            con.set_digital_output_lines(mask)
+
+    def is_marker(response):
+        return response['pressed'] and (port is None or
+                                        response['port'] == port)
+
+    raise_lines(0)
+    time.sleep(0.05)
+    device.poll_for_response()
+    device.clear_response_queue()
+
+    before = time.perf_counter()
+    device.reset_timer()
+    clock = sync_device_clock(device)
+    if clock is not None:
+        (timer_zero, clock_error) = clock
+    else:
+        # The reset is taken to happen halfway through its write, which
+        # hides the write latency being measured, see CalibrationResult
+        timer_zero = (before + time.perf_counter()) / 2.0
+        clock_error = None
+
+    latencies = []
+    round_trips = []
+    lost = 0
+    for i in range(count):
+        sent = time.perf_counter()
+        raise_lines(lines)
+        response = device.wait_for_response(timeout, is_marker)
+        received = time.perf_counter()
+
+        if response is None:
+            lost += 1
+        else:
+            latencies.append(response['time'] - (sent - timer_zero) * 1000.0)
+            round_trips.append((received - sent) * 1000.0)
+
+        raise_lines(0)
+        time.sleep(interval)
+        device.poll_for_response()
+        device.clear_response_queue()
+
+    info = {'device': device.device_name,
+            'serial': con.serial.decode('latin1')
+                if isinstance(con.serial, bytes) else con.serial,
+            'profile': con.profile.name,
+            'io_mode': con.get_io_mode(),
+            'lines': lines,
+            'clock_sync': 'timer_query' if clock is not None
+                else 'reset_timer',
+            'clock_error_ms': clock_error,
+            'method': 'set_digio_lines_to_mask' if use_mask
+                else 'set_digital_output_lines',
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    return CalibrationResult(latencies, round_trips, lost, info)
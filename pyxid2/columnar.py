@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar recording of response streams.
+
+ResponseColumns collects port, key, pressed, device time and (optionally)
+host time of every response into typed arrays as the packets are parsed,
+without building a dict per response. The columns can be exported to a
+pandas DataFrame or a PyArrow table without converting row by row, or
+written to a Parquet file in chunks so memory stays bounded in long
+sessions.
+
+Example:
+    columns = ResponseColumns(host_time=True)
+    dev.record_responses(columns)
+    ...
+    frame = columns.to_pandas()
+
+pandas and pyarrow are only imported by the export methods, and only
+needed if they are used.
+"""
+import queue
+import threading
+import time
+from array import array
+
+from .keymaps import map_key
+
+# A typecode with 4 byte items, for the device timestamps
+_UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+
+
+class ResponseColumns(object):
+    """
+    Growable typed columns of responses: 'port' (uint8), 'key' (int16),
+    'pressed' (bool, stored as uint8), 'time' (uint32, device miliseconds)
+    and, if host_time is True, 'host_time' (float64, time.time() when the
+    response was parsed).
+
+    If parquet_path is given, the rows are handed to a writer thread, which
+    writes them to that Parquet file as a row group, whenever chunk_size
+    rows have been collected, and dropped from memory. append() runs while
+    packets are parsed, so it never waits for the disk. Call close() at the
+    end of the session to write the remaining rows and finish the file.
+    """
+    def __init__(self, host_time=False, parquet_path=None, chunk_size=65536):
+        self.host_time = host_time
+        self.parquet_path = parquet_path
+        self.chunk_size = chunk_size
+        # Set by XidDevice.record_responses(), applied like in
+        # poll_for_response()
+        self.keymap = None
+        self.rows_written = 0
+        self.__lock = threading.Lock()
+        self.__parquet_writer = None
+        self.__chunks = None
+        self.__chunk_thread = None
+        self.__chunk_error = None
+        self.__clear()
+
+        if parquet_path is not None:
+            # Imported now rather than by the writer thread in the middle of
+            # a session, which would hold up packet parsing
+            import pyarrow.parquet
+
+    def __clear(self):
+        self.port = array('B')
+        self.key = array('h')
+        self.pressed = array('B')
+        self.time = array(_UINT32)
+        self.host = array('d')
+
+    def __len__(self):
+        return len(self.time)
+
+    def append(self, port, key, pressed, device_time):
+        """
+        Adds a response. key is the key reported by the device; the keymap
+        is applied here.
+        """
+        with self.__lock:
+            self.port.append(port)
+            self.key.append(map_key(self.keymap, port, key))
+            self.pressed.append(1 if pressed else 0)
+            self.time.append(device_time)
+            if self.host_time:
+                self.host.append(time.time())
+
+            if self.parquet_path is not None and \
+                    len(self.time) >= self.chunk_size:
+                self.__queue_chunk()
+
+    def columns(self):
+        """
+        Returns the columns as a dict of name to array.array
+        """
+        columns = {'port': self.port,
+                   'key': self.key,
+                   'pressed': self.pressed,
+                   'time': self.time}
+        if self.host_time:
+            columns['host_time'] = self.host
+
+        return columns
+
+    def to_arrow(self):
+        """
+        Returns the rows held in memory as a pyarrow.Table. The arrays'
+        buffers are copied once, with no per-row conversion.
+        """
+        import pyarrow
+
+        with self.__lock:
+            return self.__to_arrow(pyarrow, self.columns())
+
+    def __to_arrow(self, pyarrow, columns):
+        types = {'port': pyarrow.uint8(),
+                 'key': pyarrow.int16(),
+                 'pressed': pyarrow.uint8(),
+                 'time': pyarrow.uint32(),
+                 'host_time': pyarrow.float64()}
+        arrays = []
+        names = []
+        for (name, column) in columns.items():
+            values = pyarrow.Array.from_buffers(
+                types[name], len(column),
+                [None, pyarrow.py_buffer(column.tobytes())])
+            if name == 'pressed':
+                values = values.cast(pyarrow.bool_())
+            arrays.append(values)
+            names.append(name)
+
+        return pyarrow.Table.from_arrays(arrays, names)
+
+    def to_pandas(self):
+        """
+        Returns the rows held in memory as a pandas.DataFrame
+        """
+        import numpy
+        import pandas
+
+        types = {'port': numpy.uint8,
+                 'key': numpy.int16,
+                 'pressed': numpy.uint8,
+                 'time': numpy.uint32,
+                 'host_time': numpy.float64}
+        with self.__lock:
+            data = dict((name, numpy.frombuffer(column.tobytes(), types[name]))
+                        for (name, column) in self.columns().items())
+
+        data['pressed'] = data['pressed'].astype(bool)
+
+        return pandas.DataFrame(data)
+
+    def flush(self):
+        """
+        Writes the rows held in memory to the Parquet file now, and waits
+        until everything handed to the writer thread is written
+        """
+        with self.__lock:
+            if self.parquet_path is not None and len(self.time) > 0:
+                self.__queue_chunk()
+            chunks = self.__chunks
+
+        if chunks is not None:
+            chunks.join()
+        self.__raise_chunk_error()
+
+    def __queue_chunk(self):
+        # Called with the lock held
+        if self.__chunk_thread is None:
+            self.__chunks = queue.Queue()
+            self.__chunk_thread = threading.Thread(target=self.__write_chunks,
+                                                   args=(self.__chunks,))
+            self.__chunk_thread.daemon = True
+            self.__chunk_thread.start()
+
+        self.__chunks.put(self.columns())
+        self.__clear()
+
+    def __write_chunks(self, chunks):
+        while True:
+            columns = chunks.get()
+            try:
+                if columns is None:
+                    return
+                if self.__chunk_error is None:
+                    self.__write_chunk(columns)
+            except Exception as exc:
+                self.__chunk_error = exc
+                print('Pyxid could not write responses to %s. Err: %s' %
+                      (self.parquet_path, exc))
+            finally:
+                chunks.task_done()
+
+    def __write_chunk(self, columns):
+        import pyarrow
+        import pyarrow.parquet
+
+        table = self.__to_arrow(pyarrow, columns)
+        if self.__parquet_writer is None:
+            self.__parquet_writer = pyarrow.parquet.ParquetWriter(
+                self.parquet_path, table.schema)
+
+        self.__parquet_writer.write_table(table)
+        self.rows_written += len(table)
+
+    def __raise_chunk_error(self):
+        if self.__chunk_error is not None:
+            raise self.__chunk_error
+
+    def close(self):
+        """
+        Writes the remaining rows and closes the Parquet file
+        """
+        try:
+            self.flush()
+        finally:
+            with self.__lock:
+                thread = self.__chunk_thread
+                if thread is not None:
+                    self.__chunks.put(None)
+                    self.__chunk_thread = None
+                    self.__chunks = None
+
+            if thread is not None:
+                thread.join()
+
+            if self.__parquet_writer is not None:
+                self.__parquet_writer.close()
+                self.__parquet_writer = None
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Encoding of XID commands and decoding of their replies.
+
+Refer to https://cedrus.com/support/xid/commands.htm
+"""
+import sys
+from array import array
+from struct import pack, unpack
+
+
+class Query(object):
+    """
+    A command that produces a reply, together with the number of bytes in
+    the reply and a function that turns the reply into a value.
+    """
+    def __init__(self, command, bytes_expected, decode):
+        self.command = command
+        self.bytes_expected = bytes_expected
+        self.decode = decode
+
+    def __repr__(self):
+        return '<Query %r (%d bytes)>' % (self.command, self.bytes_expected)
+
+
+def _selector(selector):
+    return selector.encode('latin1')
+
+
+def _flag(value):
+    return b'1' if value is True else b'0'
+
+
+# '_d2', '_d3', '_d4'
+def product_id_query():
+    return Query(b'_d2', 1, lambda reply: reply)
+
+
+def model_id_query():
+    return Query(b'_d3', 1, lambda reply: reply)
+
+
+def major_fw_version_query():
+    return Query(b'_d4', 1, lambda reply: int(reply))
+
+
+# '_e5'
+def timer_query():
+    return Query(b'_e5', 7, lambda reply: unpack('<cccI', reply)[3])
+
+
+# 'mp'/'_mp'
+def pulse_duration_command(duration):
+    return pack('<ccI', b'm', b'p', duration)
+
+
+def pulse_duration_query():
+    return Query(b'_mp', 7, lambda reply: unpack('<cccI', reply)[3])
+
+
+# 'ia'/'_ia'
+def single_shot_command(selector, action, delay):
+    return pack('<ccccI', b'i', b'a', _selector(selector), _flag(action),
+                delay)
+
+
+def _decode_single_shot(reply):
+    (_, _, _, _, action, delay) = unpack('<cccccI', reply)
+
+    return (action == b'1', delay)
+
+
+def single_shot_query(selector):
+    return Query(b'_ia' + _selector(selector), 9, _decode_single_shot)
+
+
+# 'if'/'_if'
+def signal_filter_command(selector, hold_on, hold_off):
+    return pack('<cccII', b'i', b'f', _selector(selector), hold_on, hold_off)
+
+
+def _decode_signal_filter(reply):
+    (_, _, _, _, hold_on, hold_off) = unpack('<ccccII', reply)
+
+    return (hold_on, hold_off)
+
+
+def signal_filter_query(selector):
+    return Query(b'_if' + _selector(selector), 12, _decode_signal_filter)
+
+
+# 'io'/'_io'
+def enable_digital_output_command(selector, enable):
+    return b'io' + _selector(selector) + _flag(enable)
+
+
+def enable_digital_output_query(selector):
+    return Query(b'_io' + _selector(selector), 5,
+                 lambda reply: unpack('<ccccc', reply)[4] == b'1')
+
+
+# 'iu'/'_iu'
+def enable_usb_output_command(selector, enable):
+    return b'iu' + _selector(selector) + _flag(enable)
+
+
+def enable_usb_output_query(selector):
+    return Query(b'_iu' + _selector(selector), 5,
+                 lambda reply: unpack('<ccccc', reply)[4] == b'1')
+
+
+# 'ip'/'_ip'
+def pause_output_command(pause):
+    return b'ip' + (b'0' if pause is True else b'1')
+
+
+def input_paused_query():
+    return Query(b'_ip', 4, lambda reply: unpack('<cccc', reply)[3] == b'0')
+
+
+# 'mk'/'_mk'
+def pulse_table_bitmask_command(mask):
+    return pack('<ccH', b'm', b'k', mask)
+
+
+def pulse_table_bitmask_query():
+    return Query(b'_mk', 5, lambda reply: unpack('<cccH', reply)[3])
+
+
+# 'mt', 'mc', 'mr'/'_mr', 'ms'
+def pulse_table_entry_command(time, mask):
+    return pack('<ccIH', b'm', b't', time, mask)
+
+
+def pulse_table_running_query():
+    return Query(b'_mr', 4, lambda reply: unpack('<cccc', reply)[3] == b'1')
+
+
+# 'mh'
+def output_lines_burst_command(masks):
+    """
+    The 'mh' commands setting the output lines to each of masks in turn,
+    as one buffer. masks is a sequence of ints or a NumPy integer array.
+    """
+    if hasattr(masks, 'astype'):
+        if len(masks) and (masks.min() < 0 or masks.max() > 0xFFFF):
+            raise ValueError('masks must be between 0 and 65535')
+        words = masks.astype('<u2').tobytes()
+    else:
+        try:
+            words = array('H', masks)
+        except OverflowError:
+            raise ValueError('masks must be between 0 and 65535')
+        if sys.byteorder == 'big':
+            words.byteswap()
+        words = words.tobytes()
+
+    count = len(words) // 2
+    burst = bytearray(4 * count)
+    burst[0::4] = b'm' * count
+    burst[1::4] = b'h' * count
+    burst[2::4] = words[0::2]
+    burst[3::4] = words[1::2]
+
+    return bytes(burst)
@@ -5,3 +5,8 @@ KEY_RELEASE_BITMASK = 0x10
 INVALID_PORT_BITS = 0x0C
 XID_PACKET_SIZE = 6
 ST2_PACKET_SIZE = 9
+
+# How XidConnection waits for incoming bytes. 'event' sleeps until the
+# driver signals a received character, 'queue' polls the driver's receive
+# queue and 'timeout' issues reads with a short driver timeout.
+IO_MODE_EVENT, IO_MODE_QUEUE, IO_MODE_TIMEOUT = 'event', 'queue', 'timeout'
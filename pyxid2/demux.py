@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import threading
+
+
+class PendingReply(object):
+    """
+    A command reply a caller is waiting for
+    """
+    def __init__(self, length):
+        self.length = length
+        self.reply = b''
+        self.__done = threading.Event()
+
+    def done(self):
+        return self.__done.is_set()
+
+    def wait(self, timeout):
+        return self.__done.wait(timeout)
+
+    def deliver(self, reply):
+        self.reply = reply
+        self.__done.set()
+
+
+class ReplyDemultiplexer(object):
+    """
+    Splits the byte stream coming from a device into response packets and
+    command replies.
+
+    Replies are matched to waiting callers in the order the commands were
+    written. Query replies start with '_' (e.g. '_e5' followed by the timer
+    value), except for the identification queries ('_d2' and friends) which
+    reply with a bare character; neither can be mistaken for the first byte
+    of a response packet ('k' for XID, 'o' for StimTracker 2). So while a
+    reply is pending, a packet start byte begins a response packet and
+    anything else begins the reply, taking the reply's expected length.
+
+    With no reply pending everything is passed on as packet bytes, so the
+    packet parser detects stray bytes and resynchronizes as before.
+    """
+    def __init__(self, packet_size, packet_start):
+        self.packet_size = packet_size
+        self.packet_start = packet_start
+        self.__buffer = b''
+        self.__pending = []
+        self.__lock = threading.Lock()
+
+    def set_packet_format(self, packet_size, packet_start):
+        self.packet_size = packet_size
+        self.packet_start = packet_start
+
+    def expect_reply(self, length):
+        """
+        Registers a reply of length bytes. Must be called in the same order
+        as the commands are written. Returns a PendingReply.
+        """
+        pending = PendingReply(length)
+        with self.__lock:
+            self.__pending.append(pending)
+
+        return pending
+
+    def has_pending_replies(self):
+        return len(self.__pending) > 0
+
+    def cancel(self, pending):
+        """
+        Gives up on a reply that did not arrive in time. Any partial reply
+        in the buffer is handed over, as a short read would have been.
+        """
+        with self.__lock:
+            if pending not in self.__pending:
+                return
+            if self.__pending[0] is pending and self.__starts_reply():
+                partial = self.__buffer[:pending.length]
+                self.__buffer = self.__buffer[len(partial):]
+                pending.reply = partial
+            self.__pending.remove(pending)
+
+    def reset(self):
+        """
+        Drops buffered bytes, e.g. after the driver buffers were purged
+        """
+        with self.__lock:
+            self.__buffer = b''
+
+    def __starts_reply(self):
+        head = self.__buffer[:1]
+        return head != b'' and head != self.packet_start
+
+    def buffered(self):
+        """
+        Number of bytes of an incomplete packet or reply held back
+        """
+        return len(self.__buffer)
+
+    def next_read_size(self):
+        """
+        How many bytes to ask the driver for so a read doesn't wait for
+        bytes that are not coming: the rest of the item at the head of the
+        buffer, or the smaller of a packet and the next reply. With nothing
+        buffered and no reply pending it is a single byte, so a read waiting
+        for whatever comes next returns as soon as anything arrives. Only
+        replies registered before the read starts are accounted for.
+        """
+        with self.__lock:
+            buffered = len(self.__buffer)
+            if self.__pending and (buffered == 0 or self.__starts_reply()):
+                size = self.__pending[0].length
+                if buffered == 0:
+                    size = min(size, self.packet_size)
+            elif buffered == 0:
+                size = 1
+            else:
+                size = self.packet_size
+
+            return max(1, size - buffered)
+
+    def feed(self, data):
+        """
+        Adds bytes read from the device. Complete replies are delivered to
+        their callers; returns the bytes belonging to response packets.
+        """
+        packets = []
+
+        with self.__lock:
+            self.__buffer += data
+
+            while self.__buffer:
+                if self.__pending and self.__starts_reply():
+                    pending = self.__pending[0]
+                    if len(self.__buffer) < pending.length:
+                        break
+                    self.__pending.pop(0)
+                    pending.deliver(self.__buffer[:pending.length])
+                    self.__buffer = self.__buffer[pending.length:]
+                elif len(self.__buffer) >= self.packet_size:
+                    packets.append(self.__buffer[:self.packet_size])
+                    self.__buffer = self.__buffer[self.packet_size:]
+                else:
+                    break
+
+        return b''.join(packets)
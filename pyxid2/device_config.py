@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshots of XID 2 device settings.
+
+A setting is identified by its name, e.g. 'pulse_duration', or for the
+per-input settings by a (name, selector) tuple, e.g. ('signal_filter', 'K').
+Values are what the matching XidDevice getter returns.
+"""
+
+# Settings that apply to the device as a whole
+DEVICE_SETTINGS = ('pulse_duration', 'pulse_table_bitmask', 'input_paused')
+# Settings that are configured per input selector
+SELECTOR_SETTINGS = ('signal_filter', 'single_shot', 'digital_output',
+                     'usb_output')
+# Selectors read by DeviceConfig.read() when none are given. Pass the
+# selectors of the inputs your device has if they differ.
+DEFAULT_SELECTORS = ('K', 'M')
+
+_QUERIES = {'pulse_duration': lambda b, s: b.get_pulse_duration(),
+            'pulse_table_bitmask': lambda b, s: b.get_pulse_table_bitmask(),
+            'input_paused': lambda b, s: b.is_input_paused(),
+            'signal_filter': lambda b, s: b.get_signal_filter(s),
+            'single_shot': lambda b, s: b.get_single_shot(s),
+            'digital_output': lambda b, s: b.get_enable_digital_output(s),
+            'usb_output': lambda b, s: b.get_enable_usb_output(s)}
+
+_SETTERS = {'pulse_duration':
+                lambda b, s, v: b.set_pulse_duration(v),
+            'pulse_table_bitmask':
+                lambda b, s, v: b.set_pulse_table_bitmask(v),
+            'input_paused':
+                lambda b, s, v: b.pause_output(v),
+            'signal_filter':
+                lambda b, s, v: b.set_signal_filter(s, v[0], v[1]),
+            'single_shot':
+                lambda b, s, v: b.set_single_shot(s, v[0], v[1]),
+            'digital_output':
+                lambda b, s, v: b.set_enable_digital_output(s, v),
+            'usb_output':
+                lambda b, s, v: b.set_enable_usb_output(s, v)}
+
+
+def _split_key(key):
+    if isinstance(key, tuple):
+        (name, selector) = key
+    else:
+        (name, selector) = (key, None)
+
+    if name not in _QUERIES:
+        raise ValueError('Unknown device setting %r' % (key,))
+    if (name in SELECTOR_SETTINGS) != (selector is not None):
+        raise ValueError('Setting %r needs exactly one selector' % (name,))
+
+    return (name, selector)
+
+
+def _normalize(value):
+    # Values loaded from JSON come back as lists
+    return tuple(value) if isinstance(value, list) else value
+
+
+class DeviceConfig(object):
+    """
+    A set of device settings, either read from a device or describing a
+    target configuration.
+
+    Example:
+        target = DeviceConfig({'pulse_duration': 10,
+                               ('signal_filter', 'K'): (5, 5),
+                               ('usb_output', 'K'): True})
+        report = dev.apply_config(target)
+        print(report['skipped'], 'settings were already correct')
+    """
+    def __init__(self, settings=None):
+        self.settings = {}
+        for (key, value) in (settings or {}).items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        return self.settings[key]
+
+    def __setitem__(self, key, value):
+        _split_key(key)
+        self.settings[key] = _normalize(value)
+
+    def __contains__(self, key):
+        return key in self.settings
+
+    def __len__(self):
+        return len(self.settings)
+
+    def __eq__(self, other):
+        return isinstance(other, DeviceConfig) and \
+            self.settings == other.settings
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '<DeviceConfig %r>' % (self.settings,)
+
+    @classmethod
+    def read(cls, device, selectors=DEFAULT_SELECTORS, keys=None):
+        """
+        Reads the device's settings in one pipelined pass. keys limits the
+        snapshot to the given settings; otherwise all settings are read for
+        each of the selectors. Settings the device doesn't support are left
+        out.
+        """
+        if keys is None:
+            keys = list(DEVICE_SETTINGS)
+            keys += [(name, selector) for selector in selectors
+                     for name in SELECTOR_SETTINGS]
+
+        batch = device.command_batch()
+        for key in keys:
+            (name, selector) = _split_key(key)
+            _QUERIES[name](batch, selector)
+
+        config = cls()
+        for (key, value) in zip(keys, batch.execute()):
+            if value is not None:
+                config[key] = value
+
+        return config
+
+    def diff(self, target):
+        """
+        Returns a dict of the settings in target (a DeviceConfig or dict)
+        whose value differs from this snapshot, mapped to the target value.
+        """
+        if not isinstance(target, DeviceConfig):
+            target = DeviceConfig(target)
+
+        return dict((key, value) for (key, value) in target.settings.items()
+                    if key not in self.settings or
+                    self.settings[key] != value)
+
+    def to_dict(self):
+        """
+        The settings with string keys ('signal_filter:K'), e.g. for JSON
+        """
+        return dict((key if not isinstance(key, tuple) else '%s:%s' % key,
+                     value) for (key, value) in self.settings.items())
+
+    @classmethod
+    def from_dict(cls, settings):
+        """
+        The inverse of to_dict()
+        """
+        config = cls()
+        for (key, value) in settings.items():
+            config[tuple(key.split(':', 1)) if ':' in key else key] = value
+
+        return config
+
+
+def write_settings(device, settings):
+    """
+    Writes a dict of settings to the device in one pipelined batch
+    """
+    batch = device.command_batch()
+    for (key, value) in settings.items():
+        (name, selector) = _split_key(key)
+        _SETTERS[name](batch, selector, _normalize(value))
+
+    batch.execute()
+
+
+def apply_config(device, target, current=None, save_to_flash=False):
+    """
+    Brings the device to the target configuration, writing only the
+    settings that differ. The current settings are read in one pipelined
+    pass unless a snapshot is passed in current. Returns a dict with the
+    number of settings 'written' and 'skipped'.
+    """
+    if not isinstance(target, DeviceConfig):
+        target = DeviceConfig(target)
+
+    if current is None:
+        current = DeviceConfig.read(device, keys=list(target.settings))
+
+    changes = current.diff(target)
+    if changes:
+        write_settings(device, changes)
+        if save_to_flash:
+            device.save_to_flash()
+
+    return {'written': len(changes),
+            'skipped': len(target) - len(changes)}
+
+
+class SettingsCache(object):
+    """
+    Shadow copy of device settings that have been written or read, keyed
+    like DeviceConfig settings. Counts hits and misses.
+    """
+    def __init__(self):
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """
+        Returns (True, value) on a hit and (False, None) on a miss
+        """
+        if key in self.values:
+            self.hits += 1
+            return (True, self.values[key])
+
+        self.misses += 1
+        return (False, None)
+
+    def put(self, key, value):
+        self.values[key] = value
+
+    def invalidate(self):
+        self.values = {}
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.values)}
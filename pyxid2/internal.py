@@ -1,27 +1,151 @@
 # -*- coding: utf-8 -*-
 from struct import pack
-from struct import unpack
-import sys, time
+import contextlib, sys, threading, time
 from .constants import NO_KEY_DETECTED, FOUND_KEY_DOWN, FOUND_KEY_UP, \
-     KEY_RELEASE_BITMASK, INVALID_PORT_BITS, XID_PACKET_SIZE, ST2_PACKET_SIZE
+     XID_PACKET_SIZE, ST2_PACKET_SIZE, \
+     IO_MODE_EVENT, IO_MODE_QUEUE, IO_MODE_TIMEOUT
+from .demux import ReplyDemultiplexer
+from .metrics import ConnectionStats
+from .writer import WriterThread
+from . import commands
+from .parsers import parse_xid_packet, parse_st2_packet, port_number
 
-try:
-    import ftd2xx
-except OSError as e:
-    if 'image not found' in str(e):
-        raise OSError('ftd2xx drivers are not installed (or not in expected location)'
-                      ' and these are required for the Cedrus pyxid2 library.\n'
-                      '** Download from https://www.ftdichip.com/Drivers/D2XX.htm **')
-    else:
-        raise(e)  # not an error we know so pass it on
+_ftd2xx = None
+# The D2XX status for an invalid handle, raised as a DeviceError when a
+# closed connection is used
+FT_INVALID_HANDLE = 1
 
 
+class XidError(Exception):
+    pass
+
+
+def load_ftd2xx():
+    """
+    Imports the ftd2xx driver bindings on first use, so that importing
+    pyxid2 does not load the native D2XX library (or fail on machines
+    without it) until a device is actually scanned for or opened.
+    """
+    global _ftd2xx
+
+    if _ftd2xx is None:
+        try:
+            import ftd2xx
+        except OSError as e:
+            if 'image not found' in str(e):
+                raise OSError('ftd2xx drivers are not installed (or not in expected location)'
+                              ' and these are required for the Cedrus pyxid2 library.\n'
+                              '** Download from https://www.ftdichip.com/Drivers/D2XX.htm **')
+            else:
+                raise(e)  # not an error we know so pass it on
+
+        _ftd2xx = ftd2xx
+
+    return _ftd2xx
+
+
+class ConnectionProfile(object):
+    """
+    FTDI driver settings applied when a connection is opened.
+
+        latency_timer: Miliseconds the FTDI chip waits before sending a
+                       partially filled USB packet to the host. Short
+                       packets (responses, query replies) are delayed by up
+                       to this much.
+        usb_in_size:   USB transfer size for data from the device, in bytes
+                       (a multiple of 64).
+        usb_out_size:  USB transfer size for data to the device, in bytes.
+        read_timeout:  Driver read timeout for command replies, miliseconds.
+        write_timeout: Driver write timeout, miliseconds.
+    """
+    def __init__(self, name, latency_timer, usb_in_size=64, usb_out_size=64,
+                 read_timeout=100, write_timeout=100):
+        self.name = name
+        self.latency_timer = latency_timer
+        self.usb_in_size = usb_in_size
+        self.usb_out_size = usb_out_size
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+
+    def __repr__(self):
+        return ('<ConnectionProfile "%s" latency_timer=%d usb=%d/%d>' %
+                (self.name, self.latency_timer, self.usb_in_size,
+                 self.usb_out_size))
+
+
+# Lowest delivery delay for short packets, for reaction time measurement.
+LOW_LATENCY_PROFILE = ConnectionProfile('low_latency', 1)
+# The settings pyxid2 has always used.
+BALANCED_PROFILE = ConnectionProfile('balanced', 10)
+# Large USB transfers for streaming many events, e.g. from a StimTracker.
+THROUGHPUT_PROFILE = ConnectionProfile('throughput', 16, 4096, 4096)
+
+CONNECTION_PROFILES = dict((profile.name, profile) for profile in
+                           (LOW_LATENCY_PROFILE, BALANCED_PROFILE,
+                            THROUGHPUT_PROFILE))
+
+
+def get_connection_profile(profile):
+    """
+    Returns the ConnectionProfile for profile, which may be a profile, one
+    of the names in CONNECTION_PROFILES, or None for the balanced profile.
+    """
+    if profile is None:
+        return BALANCED_PROFILE
+    if isinstance(profile, ConnectionProfile):
+        return profile
+    if profile in CONNECTION_PROFILES:
+        return CONNECTION_PROFILES[profile]
+
+    raise ValueError('Unknown connection profile %r' % (profile,))
+
+
+def list_ftdi_devices():
+    """
+    Returns the driver's info dict (see ftd2xx.getDeviceInfoDetail) for
+    each FTDI device currently attached, in device index order.
+    """
+    ftd2xx = load_ftd2xx()
+
+    return [ftd2xx.getDeviceInfoDetail(i)
+            for i in range(ftd2xx.createDeviceInfoList())]
+
 
 class XidConnection(object):
-    def __init__(self, ftd2xx_index, baud_rate):
+    """
+    Connection to a single XID device through the FTDI D2XX driver.
+
+    XidConnection may be used from several threads, e.g. one polling for
+    responses while another sends event markers. Writes are serialized by a
+    write lock, and reads (including the read of a command's reply) by a
+    read lock, so a command and its reply are never split by a poll and
+    markers don't wait for a poll in progress. The read lock is always taken
+    before the write lock.
+    """
+    # Sleep between receive queue checks in IO_MODE_QUEUE, in seconds
+    QUEUE_POLL_INTERVAL = 0.0005
+    # How often a thread waiting for a reply checks whether the thread
+    # reading from the device has released it, in seconds
+    REPLY_WAIT_INTERVAL = 0.001
+    # Longest driver read timeout in IO_MODE_TIMEOUT while command replies
+    # are pending. The read size is chosen before a read starts, so a reply
+    # another thread starts waiting for during a read is only asked for by
+    # the next one.
+    READ_SLICE_MS = 2
+
+    def __init__(self, ftd2xx_index, baud_rate, profile=None,
+                 device_info=None):
         self.ftd2xx_index = ftd2xx_index
+        # Identify the device across reconnects, where its index may change
+        device_info = device_info or {}
+        self.serial = device_info.get('serial', b'')
+        self.location = device_info.get('location')
+        self.description = device_info.get('description', b'')
         self.ftd2xx_con = 0
+        # Set by the XidDevice using the connection
+        self.owner = None
         self.baudrate = baud_rate
+        self.profile = get_connection_profile(profile)
         self.__needs_interbyte_delay = True
         self.__packet_size = XID_PACKET_SIZE
         self.__response_buffer = b''
@@ -31,6 +155,26 @@ class XidConnection(object):
         self.__using_stim_tracker = False
         self.__set_lines_cmd = 'ah'+chr(0)+chr(0)
         self.__line_state = 0
+        self.__response_filter = None
+        self.__response_recorder = None
+        self.__queue_recorded = True
+        self.stats = ConnectionStats()
+        # Line command coalescing, see coalesced_output_lines()
+        self.__coalescing = 0
+        self.__coalescing_window = 0
+        self.__lines_pending = False
+        self.__lines_timer = None
+        self.__writer = None
+        # Whether start_writer() was called, so open() restarts the writer
+        # close() stopped
+        self.__writer_requested = False
+        self.__requested_io_mode = IO_MODE_TIMEOUT
+        self.__io_mode = IO_MODE_TIMEOUT
+        self.__rx_event = None
+        self.__read_lock = threading.RLock()
+        self.__write_lock = threading.RLock()
+        self.__read_timeout = None
+        self.__demux = ReplyDemultiplexer(XID_PACKET_SIZE, b'k')
 
     def set_using_stim_tracker_output(self, using_st=True):
         if using_st:
@@ -45,24 +189,184 @@ class XidConnection(object):
     def set_resp_packet_size(self, st2_packet_size=True):
         if st2_packet_size:
             self.__packet_size = ST2_PACKET_SIZE # ST2 packets are larger
+            self.__demux.set_packet_format(ST2_PACKET_SIZE, b'o')
+
+    def set_response_filter(self, response_filter=None):
+        """
+        Installs a ResponseFilter that is applied to every packet as it is
+        parsed. Pass None to remove the filter.
+        """
+        self.__response_filter = response_filter
+
+    def set_response_recorder(self, recorder=None, queue=True):
+        """
+        Installs a recorder whose append(port, key, pressed, time) is called
+        with every response that passes the filter, as it is parsed, e.g. a
+        columnar.ResponseColumns. With queue=False recorded responses are
+        not queued as well. Pass None to remove it.
+        """
+        self.__response_recorder = recorder
+        self.__queue_recorded = queue or recorder is None
 
     def clear_digital_output_lines(self, lines, leave_remaining_lines=False):
-        if lines not in list(range(0, 65536)):
+        if lines not in range(0, 65536):
             raise ValueError('lines must be between 0 and 65535')
 
         local_lines = ~lines
         if local_lines < 0:
             local_lines += 65536
 
-        self.set_digital_output_lines(local_lines, leave_remaining_lines)
+        return self.set_digital_output_lines(local_lines,
+                                             leave_remaining_lines)
 
     def set_digital_output_lines(self, lines, leave_remaining_lines=False):
-        if lines not in list(range(0, 65536)):
+        if lines not in range(0, 65536):
             raise ValueError('lines must be between 0 and 65535')
 
-        if leave_remaining_lines:
-            lines |= self.__line_state
+        with self.__write_lock:
+            if leave_remaining_lines:
+                lines |= self.__line_state
 
+            command = self.__output_lines_command(lines)
+
+            if self.__coalescing or self.__coalescing_window > 0:
+                if self.__lines_pending:
+                    self.stats.line_writes_avoided += 1
+                self.__lines_pending = True
+                if not self.__coalescing and self.__lines_timer is None:
+                    self.__lines_timer = threading.Timer(
+                        self.__coalescing_window / 1000.0,
+                        self.commit_output_lines)
+                    self.__lines_timer.daemon = True
+                    self.__lines_timer.start()
+                return
+
+            return self.write(command)
+
+    @contextlib.contextmanager
+    def coalesced_output_lines(self):
+        """
+        Within the with block, digital output line changes are only
+        recorded in the line state; the final state is written once when
+        the block ends (or at commit_output_lines()). Other commands
+        written in the meantime are preceded by the pending line command,
+        so the order of writes is kept.
+        """
+        with self.__write_lock:
+            self.__coalescing += 1
+        try:
+            yield self
+        finally:
+            with self.__write_lock:
+                self.__coalescing -= 1
+                if self.__coalescing == 0:
+                    self.commit_output_lines()
+
+    def set_coalescing_window(self, window):
+        """
+        Coalesces digital output line changes made within window
+        miliseconds of the first one into one write, sent when the window
+        ends. 0 (the default) writes each change right away.
+        """
+        with self.__write_lock:
+            self.__coalescing_window = window
+            if window <= 0:
+                self.commit_output_lines()
+
+    def commit_output_lines(self):
+        """
+        Writes the pending digital output line state now, if there is one.
+        Returns True if anything was written.
+        """
+        with self.__write_lock:
+            if self.__lines_timer is not None:
+                self.__lines_timer.cancel()
+                self.__lines_timer = None
+
+            if not self.__lines_pending:
+                return False
+
+            # write_bytes() sends the pending line command first
+            self.write_bytes(b'')
+
+            return True
+
+    def set_digital_output_lines_burst(self, masks, hold=0):
+        """
+        Sets the output lines to each of masks in turn. masks is a sequence
+        of ints or a NumPy integer array.
+
+        With no hold time all the commands are sent together, in a single
+        driver write on StimTracker and XID 2 devices. Otherwise each mask
+        is written on its own and held for hold miliseconds, timed from the
+        start of the burst so the steps don't drift; these writes bypass
+        the writer thread (after it has written what it had queued), so the
+        hold times are kept on the wire and not just between queueing. XID
+        1 devices get their bytes one write at a time, with their
+        inter-byte delay.
+
+        Returns the number of driver writes made.
+        """
+        count = len(masks)
+        if count == 0:
+            return 0
+
+        with self.__write_lock:
+            # The burst supersedes any pending line command
+            self.__lines_pending = False
+
+            if self.__using_stim_tracker:
+                burst = commands.output_lines_burst_command(masks)
+            else:
+                burst = b''.join(
+                    self.__output_lines_command(int(mask)).encode('latin1')
+                    for mask in masks)
+
+            if hold <= 0:
+                self.write_bytes(burst)
+                writes = self.__driver_writes(burst)
+            else:
+                self.__drain_writer()
+                start = time.perf_counter()
+                writes = 0
+                for i in range(count):
+                    command = burst[4 * i:4 * i + 4]
+                    self.__write_now(command)
+                    writes += self.__driver_writes(command)
+                    self.__hold_until(start + (i + 1) * hold / 1000.0)
+
+            self.__output_lines_command(int(masks[count - 1]))
+
+        return writes
+
+    def __driver_writes(self, command):
+        # XID 1 devices get each byte in a write of its own
+        return len(command) if self.__needs_interbyte_delay else 1
+
+    def __hold_until(self, deadline):
+        # Sleeps for most of the wait and spins for the last milisecond,
+        # which sleep() can overshoot
+        remaining = deadline - time.perf_counter()
+        if remaining > 0.001:
+            time.sleep(remaining - 0.001)
+        while time.perf_counter() < deadline:
+            pass
+
+    def digital_output_lines_command(self, lines):
+        """
+        Returns the command (bytes) that sets the digital output lines to
+        lines, and records lines as the current line state. For sending the
+        command together with others, e.g. in a CommandBatch.
+        """
+        if lines not in range(0, 65536):
+            raise ValueError('lines must be between 0 and 65535')
+
+        with self.__write_lock:
+            # The returned command supersedes any pending one
+            self.__lines_pending = False
+            return self.__output_lines_command(lines).encode('latin1')
+
+    def __output_lines_command(self, lines):
         if self.__using_stim_tracker:
             self.__set_lines_cmd = 'mh'+chr(lines & 0x000000FF)+chr((lines >> 8) & 0x000000FF)
         else:
@@ -71,116 +375,486 @@ class XidConnection(object):
                 lines_tmp += 65536
             self.__set_lines_cmd = 'ah'+chr(lines_tmp & 0x000000FF)+chr((lines >> 8) & 0x000000FF)
 
-        self.write(self.__set_lines_cmd)
         self.__line_state = lines
 
+        return self.__set_lines_cmd
+
     def set_digio_lines_to_mask(self, lines):
         command_char = b'm' if self.__using_stim_tracker else b'a'
 
         digio_cmd = pack('<ccH', command_char, b'h', lines)
-        self.write_bytes(digio_cmd)
+        return self.write_bytes(digio_cmd)
 
     def flush(self, mask=0):
-        self.ftd2xx_con.purge(mask)
+        with self.__read_lock, self.__write_lock:
+            self.__drain_writer()
+            self.__handle().purge(mask)
+            self.__demux.reset()
+            self.stats.flushes += 1
+
+    def flush_then_write(self, command, mask=0):
+        """
+        Purges the driver buffers (see flush()), drops partly received and
+        parsed but unclaimed responses, and writes command (bytes), holding
+        the locks throughout so no read happens in between. Returns the
+        time.perf_counter() time the write finished.
+        """
+        with self.__read_lock, self.__write_lock:
+            self.__drain_writer()
+            self.__handle().purge(mask)
+            self.__demux.reset()
+            self.stats.flushes += 1
+            self.__response_buffer = b''
+            self.__response_structs_queue = []
+            handle = self.write_bytes(command)
+
+        if hasattr(handle, 'wait'):
+            # Queued on the writer thread
+            handle.wait()
+            return handle.sent
+
+        return time.perf_counter()
 
     def open(self):
-        for attempt in range(5):
+        ftd2xx = load_ftd2xx()
+
+        with self.__read_lock, self.__write_lock:
+            for attempt in range(5):
+                try:
+                    if self.serial:
+                        self.ftd2xx_con = ftd2xx.openEx(self.serial)
+                    else:
+                        self.ftd2xx_con = ftd2xx.open(self.ftd2xx_index)
+                except ftd2xx.DeviceError:
+                    time.sleep(0.005)
+                else:
+                    self.ftd2xx_con.setBaudRate(self.baudrate)
+                    self.ftd2xx_con.setDataCharacteristics(8, 0, 0)
+
+                    self.__apply_profile()
+                    self.flush()
+                    self.set_io_mode(self.__requested_io_mode)
+                    if self.__writer_requested:
+                        self.start_writer()
+
+                    return True
+
+            return False
+
+    def matches(self, device_info):
+        """
+        True if device_info (see list_ftdi_devices()) describes the device
+        of this connection: same serial number, or same USB location for
+        devices without one.
+        """
+        if self.serial:
+            return device_info.get('serial') == self.serial
+        return self.location is not None and \
+            device_info.get('location') == self.location
+
+    def reopen(self, device_list=None):
+        """
+        Closes the connection and opens the same device again, e.g. after
+        it was unplugged and plugged back in. The device is looked up by
+        serial number or location in device_list (list_ftdi_devices() if
+        not given), since its index may have changed. Returns False if the
+        device is not attached or could not be opened.
+        """
+        self.close()
+
+        if device_list is None:
+            device_list = list_ftdi_devices()
+
+        for (index, device_info) in enumerate(device_list):
+            if self.matches(device_info):
+                self.ftd2xx_index = index
+                break
+        else:
+            return False
+
+        with self.__read_lock:
+            self.__response_buffer = b''
+
+        return self.open()
+
+    def restore_output_lines(self):
+        """
+        Writes the last digital output line state to the device again
+        """
+        self.set_digital_output_lines(self.__line_state)
+
+    def __apply_profile(self):
+        self.ftd2xx_con.setTimeouts(self.profile.read_timeout,
+                                    self.profile.write_timeout)
+        self.__read_timeout = self.profile.read_timeout
+        self.ftd2xx_con.setUSBParameters(self.profile.usb_in_size,
+                                         self.profile.usb_out_size)
+        self.ftd2xx_con.setLatencyTimer(self.profile.latency_timer)
+
+    def __set_read_timeout(self, timeout):
+        # Only called with the read lock held. The write timeout always
+        # stays at the profile's value, so writes never need to change it.
+        if timeout != self.__read_timeout:
+            self.__handle().setTimeouts(timeout, self.profile.write_timeout)
+            self.__read_timeout = timeout
+
+    def set_profile(self, profile):
+        """
+        Selects the ConnectionProfile (or profile name) used by this
+        connection. Applied immediately if the connection is open.
+        """
+        with self.__read_lock, self.__write_lock:
+            self.profile = get_connection_profile(profile)
+
+            if self.ftd2xx_con != 0:
+                self.__apply_profile()
+
+    def close(self):
+        ftd2xx = load_ftd2xx()
+
+        # Kept requested, so the writer is back when the connection is
+        # opened again
+        self.__stop_writer_thread()
+
+        with self.__read_lock, self.__write_lock:
             try:
-                self.ftd2xx_con = ftd2xx.open(self.ftd2xx_index)
+                if self.ftd2xx_con != 0:
+                    self.ftd2xx_con.close()
             except ftd2xx.DeviceError:
-                time.sleep(0.005)
+                return False
             else:
-                self.ftd2xx_con.setBaudRate(self.baudrate)
-                self.ftd2xx_con.setDataCharacteristics(8, 0, 0)
+                return True
+            finally:
+                self.ftd2xx_con = 0
+                self.__rx_event = None
+                if self.__lines_timer is not None:
+                    self.__lines_timer.cancel()
+                    self.__lines_timer = None
+
+    def set_io_mode(self, io_mode):
+        """
+        Selects how the connection waits for incoming bytes:
+
+            IO_MODE_EVENT:   sleep until the driver signals a received
+                             character (Linux only), then read exactly the
+                             bytes in the receive queue.
+            IO_MODE_QUEUE:   check the driver's receive queue at a short
+                             interval and read as soon as it is non-empty.
+            IO_MODE_TIMEOUT: issue reads with a driver timeout (the
+                             original behavior).
+
+        If a mode can't be used the next one in that list is used instead.
+        The mode is kept across open() calls. Returns the active mode.
+        """
+        if io_mode not in (IO_MODE_EVENT, IO_MODE_QUEUE, IO_MODE_TIMEOUT):
+            raise ValueError('Unknown io mode %r' % io_mode)
 
-                self.ftd2xx_con.setTimeouts(100, 100)
-                self.ftd2xx_con.setUSBParameters(64,64)
-                self.ftd2xx_con.setLatencyTimer(10)
-                self.flush()
+        with self.__read_lock:
+            return self.__enable_io_mode(io_mode)
 
-                return True
+    def __enable_io_mode(self, io_mode):
+        self.__requested_io_mode = io_mode
+        self.__io_mode = IO_MODE_TIMEOUT
+        self.__rx_event = None
 
-        return False
+        if self.ftd2xx_con == 0:
+            return self.__io_mode
 
-    def close(self):
-        try:
-            if self.ftd2xx_con != 0:
-                self.ftd2xx_con.close()
-        except ftd2xx.DeviceError:
-            return False
-        else:
-            return True
+        if io_mode == IO_MODE_EVENT:
+            from .notification import FT_EVENT_RXCHAR, RxCharEvent
+            ftd2xx = load_ftd2xx()
 
-    def send_xid_command(self, command, bytes_expected=0):
-        self.write(command)
+            try:
+                rx_event = RxCharEvent()
+                self.ftd2xx_con.setEventNotification(FT_EVENT_RXCHAR,
+                                                     rx_event.address())
+            except (OSError, AttributeError, ftd2xx.DeviceError) as exc:
+                print('Pyxid could not enable FTDI event notification, '
+                      'polling the receive queue instead. Err: ' + str(exc))
+                io_mode = IO_MODE_QUEUE
+            else:
+                self.__rx_event = rx_event
+                self.__io_mode = IO_MODE_EVENT
 
-        response = self.read(bytes_expected)
+        if io_mode == IO_MODE_QUEUE:
+            if hasattr(self.ftd2xx_con, 'getQueueStatus'):
+                self.__io_mode = IO_MODE_QUEUE
 
-        return response
+        return self.__io_mode
+
+    def get_io_mode(self):
+        """
+        The io mode currently in use, see set_io_mode()
+        """
+        return self.__io_mode
+
+    def wait_for_bytes(self, timeout):
+        """
+        Waits up to timeout miliseconds for bytes to arrive and returns how
+        many are waiting in the driver's receive queue. Only used in
+        IO_MODE_EVENT and IO_MODE_QUEUE.
+        """
+        queue_status = self.__handle().getQueueStatus
+
+        bytes_waiting = queue_status()
+        if bytes_waiting > 0 or timeout <= 0:
+            return bytes_waiting
+
+        if self.__io_mode == IO_MODE_EVENT:
+            self.__rx_event.wait(timeout, lambda: queue_status() > 0)
+            return queue_status()
+
+        deadline = time.perf_counter() + timeout / 1000.0
+        while bytes_waiting == 0 and time.perf_counter() < deadline:
+            time.sleep(self.QUEUE_POLL_INTERVAL)
+            bytes_waiting = queue_status()
+
+        return bytes_waiting
+
+    def send_xid_command(self, command, bytes_expected=0):
+        if sys.version_info >= (3, 0):
+            command = command.encode('latin1')
+
+        return self.send_xid_byte_command(command, bytes_expected)
 
     def send_xid_byte_command(self, command, bytes_expected=0):
-        self.write_bytes(command)
+        return self.send_xid_commands([(command, bytes_expected)])[0]
+
+    def send_xid_commands(self, commands):
+        """
+        Sends several commands back to back and collects their replies.
 
-        response = self.read(bytes_expected)
+        commands is a list of (command bytes, bytes expected) pairs. All
+        commands are written in one go. Each reply is picked out of the
+        incoming stream by the reply demultiplexer, so response packets that
+        arrive in between are still queued as responses, and another thread
+        may be polling for responses at the same time.
 
-        return response
+        Returns the list of replies in command order. A reply is short (or
+        empty) if the device did not answer within the profile's read
+        timeout.
+        """
+        with self.__write_lock:
+            pending = [self.__demux.expect_reply(expected)
+                       for (_, expected) in commands if expected > 0]
+            sent = time.perf_counter()
+            try:
+                handle = self.write_bytes(
+                    b''.join(command for (command, _) in commands))
+            except Exception:
+                self.__cancel_replies(pending)
+                raise
+
+        written = time.perf_counter()
+        if hasattr(handle, 'wait'):
+            # Queued on the writer thread: the device can't answer before
+            # the commands have gone out, so the timeout starts then
+            handle.wait()
+            if handle.error is not None:
+                self.__cancel_replies(pending)
+                raise handle.error
+            written = handle.sent
+
+        deadline = written + self.profile.read_timeout / 1000.0
+        for reply in pending:
+            self.__wait_for_reply(reply, deadline)
+
+        self.stats.commands += len(commands)
+        if pending:
+            timeouts = sum(1 for reply in pending if not reply.done())
+            if timeouts:
+                self.stats.command_timeouts += timeouts
+            else:
+                self.stats.observe_rtt((time.perf_counter() - sent) * 1000.0)
+
+        replies = iter([reply.reply for reply in pending])
+
+        return [next(replies) if expected > 0 else b''
+                for (_, expected) in commands]
+
+    def __cancel_replies(self, pending):
+        # No replies are coming for commands that weren't written
+        for reply in pending:
+            self.__demux.cancel(reply)
+
+    def __wait_for_reply(self, pending, deadline):
+        # Whoever holds the read lock feeds the demultiplexer, which hands
+        # the reply over. If that's another thread (polling for responses)
+        # wait for it to deliver, otherwise read from the device ourselves.
+        while not pending.done():
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                self.__demux.cancel(pending)
+                return
+
+            if self.__read_lock.acquire(False):
+                try:
+                    if not pending.done():
+                        self.__read_input(max(1, int(remaining * 1000)))
+                finally:
+                    self.__read_lock.release()
+            else:
+                pending.wait(min(remaining, self.REPLY_WAIT_INTERVAL))
+
+    def __read_input(self, timeout):
+        # Reads whatever the device sends within timeout miliseconds,
+        # delivers command replies and parses response packets. Called with
+        # the read lock held.
+        if self.__io_mode == IO_MODE_TIMEOUT:
+            data = self.__timed_read(timeout)
+        else:
+            bytes_waiting = self.wait_for_bytes(timeout)
+            data = self.read(bytes_waiting) if bytes_waiting else b''
+
+        response_found = NO_KEY_DETECTED
+        if len(data) > 0:
+            self.__response_buffer += self.__demux.feed(data)
+            if self.__io_mode == IO_MODE_TIMEOUT and self.__demux.buffered():
+                # The rest of the packet or reply whose first bytes ended
+                # the read, usually in the same USB transfer
+                self.__set_read_timeout(self.READ_SLICE_MS)
+                self.__response_buffer += self.__demux.feed(
+                    self.read(self.__demux.next_read_size()))
+            if self.__packet_size == 6:
+                response_found = self.xid_input_found()
+            else:
+                response_found = self.st2_input_found()
+
+        return response_found
+
+    def __handle(self):
+        # The driver handle, or the error the driver raises for an invalid
+        # handle if the connection is closed (e.g. by a DeviceMonitor after
+        # the device was unplugged)
+        ftd2xx_con = self.ftd2xx_con
+        if ftd2xx_con == 0:
+            raise load_ftd2xx().DeviceError(FT_INVALID_HANDLE)
+
+        return ftd2xx_con
+
+    def __timed_read(self, timeout):
+        # One read waiting up to timeout miliseconds for whatever comes
+        # next, see ReplyDemultiplexer.next_read_size(). While replies are
+        # pending it is split into READ_SLICE_MS reads, so the size of each
+        # takes the replies registered in the meantime into account.
+        deadline = time.perf_counter() + timeout / 1000.0
+        while True:
+            remaining = max(1, int((deadline - time.perf_counter()) * 1000))
+            read_timeout = remaining
+            if self.__demux.has_pending_replies():
+                read_timeout = min(self.READ_SLICE_MS, remaining)
+
+            self.__set_read_timeout(read_timeout)
+            data = self.read(self.__demux.next_read_size())
+            if data or read_timeout >= remaining:
+                return data
 
     def read(self, bytes_to_read):
-        return self.ftd2xx_con.read(bytes_to_read)
+        return self.__handle().read(bytes_to_read)
 
     def set_timeout(self, timeout):
-        self.ftd2xx_con.setTimeouts(timeout, 50)
+        with self.__read_lock:
+            self.__set_read_timeout(timeout)
 
     def write(self, command):
         bytes_written = 0
         cmd_bytes = []
 
-        self.ftd2xx_con.setTimeouts(100, 100)
-
         for i in command:
             if (sys.version_info >= (3, 0)):
                 cmd_bytes += i.encode('latin1')
             else:
                 cmd_bytes += i
 
-        if self.__needs_interbyte_delay:
-            for char in cmd_bytes:
-                bytes_written += self.ftd2xx_con.write(bytes([char]))
-                time.sleep(0.001)
-        else:
-            bytes_written = self.ftd2xx_con.write(bytes(cmd_bytes))
+        return self.write_bytes(bytes(cmd_bytes))
 
-        return bytes_written
+    def start_writer(self):
+        """
+        Hands all writes to a writer thread: write_bytes() and the methods
+        using it queue the command and return a writer.WriteHandle right
+        away instead of waiting for the driver. Commands are written in the
+        order they were queued, so markers and other commands keep their
+        order. Queue depth and send latency are kept in stats. The writer
+        stays on across close() and open(), e.g. through a reconnect.
+        """
+        with self.__write_lock:
+            self.__writer_requested = True
+            if self.__writer is None:
+                self.__writer = WriterThread(self.__write_now, self.stats)
+
+    def stop_writer(self):
+        """
+        Writes whatever is still queued and goes back to writing directly
+        """
+        with self.__write_lock:
+            self.__writer_requested = False
+            self.__stop_writer_thread()
+
+    def __stop_writer_thread(self):
+        with self.__write_lock:
+            if self.__writer is not None:
+                self.__writer.stop()
+                self.__writer = None
+
+    def __drain_writer(self):
+        # Called with the write lock held, so nothing new is queued. The
+        # driver buffers must not be purged while a queued write is going
+        # out.
+        if self.__writer is not None:
+            self.__writer.drain()
+
+    def writer_queue_depth(self):
+        """
+        Number of commands waiting for the writer thread, 0 without one
+        """
+        writer = self.__writer
+        return writer.queue_depth() if writer is not None else 0
 
     def write_bytes(self, command):
-        bytes_written = 0
+        with self.__write_lock:
+            if self.__lines_pending:
+                self.__lines_pending = False
+                command = self.__set_lines_cmd.encode('latin1') + command
+
+            if self.__writer is not None:
+                return self.__writer.submit(command)
 
-        self.ftd2xx_con.setTimeouts(100, 100)
+            return self.__write_now(command)
+
+    def __write_now(self, command):
+        # Called with the write lock held, or by the writer thread
+        bytes_written = 0
+        ftd2xx_con = self.__handle()
 
         if self.__needs_interbyte_delay:
-            for char in command:
-                bytes_written += self.ftd2xx_con.write(char)
+            for char in bytearray(command):
+                bytes_written += ftd2xx_con.write(bytes([char]))
                 time.sleep(0.001)
         else:
-            bytes_written = self.ftd2xx_con.write(command)
+            bytes_written = ftd2xx_con.write(command)
 
         return bytes_written
 
-    def check_for_keypress(self):
-        self.ftd2xx_con.setTimeouts(2, 50)
-        response = self.read(self.__packet_size)
+    def check_for_keypress(self, timeout=2):
+        """
+        Reads from the device and parses any complete packets, waiting at
+        most timeout miliseconds for bytes to arrive. In IO_MODE_TIMEOUT a
+        driver read waits for the first byte and the rest of its packet is
+        read right after; in the other io modes everything in the receive
+        queue is read at once. Command
+        replies found along the way are handed to the threads waiting for
+        them.
+        """
+        with self.__read_lock:
+            return self.__read_input(timeout)
 
-        response_found = NO_KEY_DETECTED
-        if len(response) > 0:
-            self.__response_buffer += response
-            if self.__packet_size == 6:
-                response_found = self.xid_input_found()
-            else:
-                response_found = self.st2_input_found()
+    def xid_input_found(self):
+        return self.__parse_packets(parse_xid_packet, 'xid_input_found')
 
-        return response_found
+    def st2_input_found(self):
+        return self.__parse_packets(parse_st2_packet, 'st2_input_found')
 
-    def xid_input_found(self):
+    def __parse_packets(self, parse_packet, parser_name):
         input_found = NO_KEY_DETECTED
 
         position_in_buf = 0
@@ -188,52 +862,33 @@ class XidConnection(object):
         while ((position_in_buf + self.__packet_size) <=
                len(self.__response_buffer)):
 
-            exception_free = True
-
             try:
-                (k, params, time) = unpack('<cBI',
-                                           self.__response_buffer[
-                                               position_in_buf:
-                                               (position_in_buf +
-                                                self.__packet_size)])
+                packet = parse_packet(self.__response_buffer[
+                    position_in_buf:(position_in_buf + self.__packet_size)])
             except Exception as exc:
-                exception_free = False
-                print(('Failed to unpack serial bytes in xid_input_found. '
-                      'Err: ' + str(exc)))
-
-            if exception_free:
-                """
-                Refer to PROTOCOL AND TIMING COMMANDS section of
-                https://cedrus.com/support/xid/commands.htm
-                """
-                if (k != b'k' or (params & INVALID_PORT_BITS) != 0):
+                self.stats.parse_errors += 1
+                print(('Failed to unpack serial bytes in %s. '
+                      'Err: %s' % (parser_name, exc)))
+            else:
+                if packet is None:
+                    self.stats.resyncs += 1
                     self.__response_buffer = b''
                     self.flush()
                     print('Pyxid found unparseable bytes in the buffer. '
                           'Flushing buffer.')
 
                     break
-                else:
-                    response = {'port': 0,
-                                'key': 0,
-                                'pressed': False,
-                                'time': 0}
-                    response['port'] = params & 0x0F
-                    response['key'] = ((params & 0xE0) >> 5)
-                    response['pressed'] = (params & KEY_RELEASE_BITMASK) == \
-                        KEY_RELEASE_BITMASK
-
-                    if response['key'] == 0:
-                        response['key'] = 8
-
-                    response['time'] = time
-
-                    if response['pressed']:
-                        input_found = FOUND_KEY_DOWN
-                    else:
-                        input_found = FOUND_KEY_UP
 
-                    self.__response_structs_queue += [response]
+                (port, key, pressed, time) = packet
+                port = port_number(port)
+                self.stats.count_event(port)
+                if self.__accept_response(port, key, pressed, time):
+                    if self.__response_recorder is not None:
+                        self.__response_recorder.append(port, key, pressed,
+                                                        time)
+                    if self.__queue_recorded:
+                        input_found = self.__queue_response(port, key,
+                                                            pressed, time)
 
             position_in_buf += self.__packet_size
 
@@ -241,65 +896,39 @@ class XidConnection(object):
 
         return input_found
 
-    def st2_input_found(self):
-        input_found = NO_KEY_DETECTED
-
-        position_in_buf = 0
-
-        while ((position_in_buf + self.__packet_size) <=
-               len(self.__response_buffer)):
-
-            exception_free = True
-
-            try:
-                (o, port, key, pressed, time, null_byte) = unpack('<ccBcIB',
-                                           self.__response_buffer[
-                                               position_in_buf:
-                                               (position_in_buf +
-                                                self.__packet_size)])
-            except Exception as exc:
-                exception_free = False
-                print(('Failed to unpack serial bytes in st2_input_found. '
-                      'Err: ' + str(exc)))
-
-            if exception_free:
-                """
-                Refer to PROTOCOL AND TIMING COMMANDS section of
-                https://cedrus.com/support/xid/commands.htm
-                """
-                if (o != b'o' or null_byte != 0):
-                    self.__response_buffer = b''
-                    self.flush()
-                    print('Pyxid found unparseable bytes in the buffer. '
-                          'Flushing buffer.')
-
-                    break
-                else:
-                    response = {'port': 0,
-                                'key': 0,
-                                'pressed': False,
-                                'time': 0}
-                    response['port'] = port
-                    response['key'] = key
-                    response['pressed'] = True if pressed == b'1' else False
+    def __accept_response(self, port, key, pressed, time):
+        if self.__response_filter is None:
+            return True
 
-                    if response['key'] == 0:
-                        response['key'] = 8
+        return self.__response_filter.accept(port, key, pressed, time)
 
-                    response['time'] = time
+    def __queue_response(self, port, key, pressed, time):
+        response = {'port': port,
+                    'key': key,
+                    'pressed': pressed,
+                    'time': time}
 
-                    if response['pressed']:
-                        input_found = FOUND_KEY_DOWN
-                    else:
-                        input_found = FOUND_KEY_UP
+        self.__response_structs_queue += [response]
 
-                    self.__response_structs_queue += [response]
+        return FOUND_KEY_DOWN if pressed else FOUND_KEY_UP
 
-            position_in_buf += self.__packet_size
+    def pending_response_count(self):
+        """
+        Number of parsed responses not yet handed out by
+        get_current_response()
+        """
+        return len(self.__response_structs_queue)
 
-        self.__response_buffer = self.__response_buffer[position_in_buf:]
+    def get_pending_responses(self):
+        """
+        Removes all parsed responses from the internal queue and returns
+        them as a list.
+        """
+        with self.__read_lock:
+            responses = self.__response_structs_queue
+            self.__response_structs_queue = []
 
-        return input_found
+        return responses
 
     def get_current_response(self):
         """
@@ -313,12 +942,13 @@ class XidConnection(object):
                     'pressed': False,
                     'key': 0,
                     'time': 0}
-        if len(self.__response_structs_queue) > 0:
-            # make a copy just in case any other internal members of
-            # XidConnection were tracking the structure
-            response = self.__response_structs_queue[0].copy()
-            # we will now hand over 'response' to the calling code,
-            # so remove it from the internal queue
-            self.__response_structs_queue.pop(0)
+        with self.__read_lock:
+            if len(self.__response_structs_queue) > 0:
+                # make a copy just in case any other internal members of
+                # XidConnection were tracking the structure
+                response = self.__response_structs_queue[0].copy()
+                # we will now hand over 'response' to the calling code,
+                # so remove it from the internal queue
+                self.__response_structs_queue.pop(0)
 
         return response
@@ -40,3 +40,18 @@ lumina_keymap = {1: 0,
                  6: -1,
                  7: -1,
                  8: -1}
+
+
+def map_key(keymap, port, key):
+    """
+    Translates the key number reported by the device into the 0 based key
+    index handed out by XidDevice. Only port 0 (typically the physical
+    buttons) is remapped; keys on other ports are returned unchanged.
+    """
+    if port != 0:
+        return key
+
+    if keymap is not None:
+        return keymap[key]
+
+    return key - 1
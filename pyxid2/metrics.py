@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Device health metrics.
+
+Every XidConnection counts what it does in a ConnectionStats (con.stats):
+responses parsed per port, resynchronizations after unparseable bytes,
+buffer flushes, command round-trip times, coalesced line writes and the
+send latency of the writer thread. Counting is a few integer
+increments on paths that run anyway, so it is always on.
+
+MetricsExporter serves these counters, plus the response queue depth and
+reconnect count of each device, in the Prometheus text format over HTTP on
+localhost or over a Unix domain socket:
+
+    exporter = MetricsExporter(devices, port=9464)
+    exporter.start()
+    # curl http://127.0.0.1:9464/metrics
+"""
+import threading
+import time
+
+
+class ConnectionStats(object):
+    """
+    Counters kept by an XidConnection. Command round-trips (from writing a
+    command to receiving its last reply) are kept as a histogram with
+    RTT_BUCKETS_MS upper bounds.
+    """
+    RTT_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100)
+
+    def __init__(self):
+        self.events = {}
+        self.resyncs = 0
+        self.parse_errors = 0
+        self.flushes = 0
+        self.commands = 0
+        self.command_timeouts = 0
+        self.line_writes_avoided = 0
+        self.write_latency_count = 0
+        self.write_latency_sum = 0.0
+        self.write_latency_max = 0.0
+        self.rtt_count = 0
+        self.rtt_sum = 0.0
+        self.rtt_buckets = [0] * len(self.RTT_BUCKETS_MS)
+
+    def count_event(self, port):
+        self.events[port] = self.events.get(port, 0) + 1
+
+    def observe_write_latency(self, latency_ms):
+        self.write_latency_count += 1
+        self.write_latency_sum += latency_ms
+        if latency_ms > self.write_latency_max:
+            self.write_latency_max = latency_ms
+
+    def observe_rtt(self, rtt_ms):
+        self.rtt_count += 1
+        self.rtt_sum += rtt_ms
+        for (i, bound) in enumerate(self.RTT_BUCKETS_MS):
+            if rtt_ms <= bound:
+                self.rtt_buckets[i] += 1
+                break
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+class MetricsExporter(object):
+    """
+    Serves the metrics of devices (a list of XidDevice) in the Prometheus
+    text format at /metrics. Listens on host:port, by default
+    127.0.0.1:9464, or on the Unix domain socket at unix_socket if given.
+    """
+    def __init__(self, devices, port=9464, host='127.0.0.1',
+                 unix_socket=None):
+        self.devices = devices
+        self.address = unix_socket or (host, port)
+        self.__unix = unix_socket is not None
+        self.__server = None
+        self.__thread = None
+        self.__last_scrape = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        # Imported here so importing pyxid2 doesn't pull in http.server
+        import socketserver
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+
+        exporter = self
+        unix = self.__unix
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def address_string(self):
+                return 'unix' if unix else \
+                    BaseHTTPRequestHandler.address_string(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        if self.__unix:
+            class Server(socketserver.ThreadingMixIn,
+                         socketserver.UnixStreamServer):
+                daemon_threads = True
+        else:
+            class Server(socketserver.ThreadingMixIn, HTTPServer):
+                daemon_threads = True
+
+        self.__server = Server(self.address, Handler)
+        self.__thread = threading.Thread(target=self.__server.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        if self.__server is None:
+            return
+
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
+        self.__server = None
+        self.__thread = None
+
+    def render(self):
+        """
+        Returns the metrics of all devices in the Prometheus text format
+        """
+        now = time.perf_counter()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (labels, value) in samples:
+                lines.append('%s{%s} %s' % (
+                    name, ','.join('%s="%s"' % (key, _escape(labels[key]))
+                                   for key in sorted(labels)), value))
+
+        devices = []
+        for (index, device) in enumerate(self.devices):
+            serial = device.con.serial
+            if isinstance(serial, bytes):
+                serial = serial.decode('latin1')
+            labels = {'device': index, 'name': device.device_name,
+                      'serial': serial}
+            devices.append((labels, device, device.con.stats))
+
+        def port_labels(labels, port):
+            port_labels = dict(labels)
+            port_labels['port'] = port
+            return port_labels
+
+        metric('pyxid_events_total', 'counter',
+               'Responses parsed, per port.',
+               [(port_labels(labels, port), count)
+                for (labels, device, stats) in devices
+                for (port, count) in sorted(stats.events.items())])
+
+        # Rate since the previous scrape, for quick looks without Prometheus
+        rates = []
+        if self.__last_scrape is not None:
+            (then, counts) = self.__last_scrape
+            elapsed = now - then
+            for (labels, device, stats) in devices:
+                for (port, count) in sorted(stats.events.items()):
+                    before = counts.get((labels['device'], port), 0)
+                    rates.append((port_labels(labels, port),
+                                  (count - before) / elapsed
+                                  if elapsed > 0 else 0.0))
+        metric('pyxid_events_per_second', 'gauge',
+               'Responses parsed per second since the previous scrape.',
+               rates)
+        self.__last_scrape = (now, dict(
+            ((labels['device'], port), count)
+            for (labels, device, stats) in devices
+            for (port, count) in stats.events.items()))
+
+        metric('pyxid_response_queue_depth', 'gauge',
+               'Responses waiting in the response queue.',
+               [(labels, len(device.response_queue) +
+                 device.con.pending_response_count())
+                for (labels, device, stats) in devices])
+        metric('pyxid_resyncs_total', 'counter',
+               'Times unparseable bytes made the parser flush the buffer.',
+               [(labels, stats.resyncs) for (labels, device, stats) in devices])
+        metric('pyxid_parse_errors_total', 'counter',
+               'Packets that could not be unpacked.',
+               [(labels, stats.parse_errors)
+                for (labels, device, stats) in devices])
+        metric('pyxid_flushes_total', 'counter',
+               'Driver buffer flushes.',
+               [(labels, stats.flushes) for (labels, device, stats) in devices])
+        metric('pyxid_commands_total', 'counter',
+               'Commands written.',
+               [(labels, stats.commands) for (labels, device, stats) in devices])
+        metric('pyxid_command_timeouts_total', 'counter',
+               'Command replies that did not arrive in time.',
+               [(labels, stats.command_timeouts)
+                for (labels, device, stats) in devices])
+        metric('pyxid_line_writes_avoided_total', 'counter',
+               'Output line writes saved by coalescing.',
+               [(labels, stats.line_writes_avoided)
+                for (labels, device, stats) in devices])
+        metric('pyxid_writer_queue_depth', 'gauge',
+               'Commands waiting for the writer thread.',
+               [(labels, device.con.writer_queue_depth())
+                for (labels, device, stats) in devices])
+        metric('pyxid_writer_latency_ms_sum', 'counter',
+               'Total time commands waited for the writer thread, in ms.',
+               [(labels, stats.write_latency_sum)
+                for (labels, device, stats) in devices])
+        metric('pyxid_writer_latency_ms_count', 'counter',
+               'Commands written by the writer thread.',
+               [(labels, stats.write_latency_count)
+                for (labels, device, stats) in devices])
+        metric('pyxid_writer_latency_ms_max', 'gauge',
+               'Longest time a command waited for the writer thread, in ms.',
+               [(labels, stats.write_latency_max)
+                for (labels, device, stats) in devices])
+        metric('pyxid_reconnects_total', 'counter',
+               'Times the device was reconnected.',
+               [(labels, device.reconnect_count)
+                for (labels, device, stats) in devices])
+
+        name = 'pyxid_command_rtt_ms'
+        lines.append('# HELP %s Command round-trip time in miliseconds.'
+                     % name)
+        lines.append('# TYPE %s histogram' % name)
+        for (labels, device, stats) in devices:
+            label_text = ','.join('%s="%s"' % (key, _escape(labels[key]))
+                                  for key in sorted(labels))
+            cumulative = 0
+            for (bound, count) in zip(stats.RTT_BUCKETS_MS,
+                                      stats.rtt_buckets):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%g"} %d' % (
+                    name, label_text, bound, cumulative))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (
+                name, label_text, stats.rtt_count))
+            lines.append('%s_sum{%s} %f' % (name, label_text, stats.rtt_sum))
+            lines.append('%s_count{%s} %d' % (name, label_text,
+                                              stats.rtt_count))
+
+        return '\n'.join(lines) + '\n'
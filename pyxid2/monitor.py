@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from .internal import list_ftdi_devices
+
+
+class DeviceMonitor(object):
+    """
+    Watches the FTDI device list in a background thread and reconnects
+    XidDevices that were unplugged once they are plugged back in.
+
+    Devices are recognized by serial number (or USB location), so a
+    reconnect doesn't rescan any ports: see XidDevice.reconnect(). While a
+    device is disconnected its reads and writes raise ftd2xx.DeviceError,
+    as they would for an unplugged device that isn't monitored.
+
+    on_disconnect(device) is called when a device disappears, and
+    on_reconnect(device, report) once it has been reopened. report is a
+    dict with the 'downtime' in miliseconds and the device's 'reconnects'
+    so far. Responses made during the downtime are lost.
+
+    Example:
+        monitor = DeviceMonitor(pyxid2.get_xid_devices())
+        monitor.start()
+        ...
+        monitor.stop()
+    """
+    def __init__(self, devices, interval=0.5, on_disconnect=None,
+                 on_reconnect=None):
+        self.devices = list(devices)
+        self.interval = interval
+        self.on_disconnect = on_disconnect
+        self.on_reconnect = on_reconnect
+        # perf_counter() time each disconnected device was found missing
+        self.__lost_since = {}
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        if self.__thread is not None:
+            return
+
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is None:
+            return
+
+        self.__stop.set()
+        self.__thread.join()
+        self.__thread = None
+
+    def disconnected_devices(self):
+        return [device for device in self.devices
+                if id(device) in self.__lost_since]
+
+    def check(self):
+        """
+        Compares the devices with the FTDI device list once, handling
+        disconnects and reconnects. Called periodically by the monitor
+        thread; can also be called directly instead of start().
+        """
+        device_list = list_ftdi_devices()
+
+        for device in self.devices:
+            attached = any(device.con.matches(device_info)
+                           for device_info in device_list)
+            lost_since = self.__lost_since.get(id(device))
+
+            if lost_since is None and not attached:
+                self.__lost_since[id(device)] = time.perf_counter()
+                device.con.close()
+                print('Pyxid lost the connection to %s.' % device.device_name)
+                if self.on_disconnect is not None:
+                    self.on_disconnect(device)
+
+            elif lost_since is not None and attached:
+                if not device.reconnect(device_list):
+                    continue
+
+                del self.__lost_since[id(device)]
+                report = {'downtime':
+                              (time.perf_counter() - lost_since) * 1000.0,
+                          'reconnects': device.reconnect_count}
+                print('Pyxid reconnected %s after %d ms. Responses made in '
+                      'the meantime were lost.' % (device.device_name,
+                                                   report['downtime']))
+                if self.on_reconnect is not None:
+                    self.on_reconnect(device, report)
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as exc:
+                print('Pyxid device monitor check failed. Err: ' + str(exc))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Receive-character event notification for the D2XX driver.
+
+On Linux the driver signals events through an EVENT_HANDLE, a struct
+holding a pthread condition variable and its mutex (see the D2XX
+Programmer's Guide, FT_SetEventNotification). RxCharEvent builds that
+struct with ctypes so a reader can sleep in pthread_cond_timedwait until
+bytes arrive instead of polling. ctypes releases the GIL for the duration
+of the wait.
+"""
+import ctypes
+import platform
+import sys
+import time
+
+FT_EVENT_RXCHAR = 1
+
+# sizeof(pthread_mutex_t) for the glibc ABIs we know about.
+# sizeof(pthread_cond_t) is 48 on all of them.
+_MUTEX_SIZES = {'x86_64': 40, 'aarch64': 48}
+_COND_SIZE = 48
+_ETIMEDOUT = 110
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long)]
+
+
+def rx_events_supported():
+    """
+    True if RxCharEvent can be used on this platform
+    """
+    return (sys.platform.startswith('linux') and
+            platform.machine() in _MUTEX_SIZES)
+
+
+class RxCharEvent(object):
+    """
+    An EVENT_HANDLE the driver signals whenever a character is received.
+    """
+    def __init__(self):
+        if not rx_events_supported():
+            raise OSError('FTDI event notification is not supported on '
+                          '%s/%s' % (sys.platform, platform.machine()))
+
+        mutex_words = _MUTEX_SIZES[platform.machine()] // 8
+
+        class _EventHandle(ctypes.Structure):
+            _fields_ = [('eCondVar', ctypes.c_longlong * (_COND_SIZE // 8)),
+                        ('eMutex', ctypes.c_longlong * mutex_words),
+                        ('iVar', ctypes.c_int)]
+
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self._handle = _EventHandle()
+        self._cond = ctypes.byref(self._handle, _EventHandle.eCondVar.offset)
+        self._mutex = ctypes.byref(self._handle, _EventHandle.eMutex.offset)
+
+        self._libc.pthread_mutex_init(self._mutex, None)
+        self._libc.pthread_cond_init(self._cond, None)
+
+    def __del__(self):
+        try:
+            self._libc.pthread_cond_destroy(self._cond)
+            self._libc.pthread_mutex_destroy(self._mutex)
+        except AttributeError:
+            pass
+
+    def address(self):
+        """
+        Address of the EVENT_HANDLE, as passed to setEventNotification()
+        """
+        return ctypes.addressof(self._handle)
+
+    def wait(self, timeout, ready):
+        """
+        Sleeps until the driver signals the event or timeout miliseconds
+        pass. ready() is checked with the mutex held before sleeping so a
+        signal sent just before the wait is never missed. Returns True if
+        ready() was already true or the event was signalled.
+        """
+        deadline = time.time() + timeout / 1000.0
+        abstime = _Timespec(int(deadline), int((deadline % 1) * 1e9))
+
+        self._libc.pthread_mutex_lock(self._mutex)
+        try:
+            if ready():
+                return True
+            result = self._libc.pthread_cond_timedwait(
+                self._cond, self._mutex, ctypes.byref(abstime))
+        finally:
+            self._libc.pthread_mutex_unlock(self._mutex)
+
+        return result != _ETIMEDOUT
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Decoding of response packets.
+
+Refer to PROTOCOL AND TIMING COMMANDS section of
+https://cedrus.com/support/xid/commands.htm
+"""
+from struct import Struct
+
+from .constants import KEY_RELEASE_BITMASK, INVALID_PORT_BITS
+
+_XID_PACKET = Struct('<cBI')
+_ST2_PACKET = Struct('<ccBcIB')
+
+
+def port_number(port):
+    """
+    The port of a response as an int. StimTracker 2 packets carry it as a
+    single byte.
+    """
+    return ord(port) if isinstance(port, bytes) else port
+
+
+def parse_xid_packet(packet):
+    """
+    Decodes a 6 byte XID response packet into (port, key, pressed, time).
+    Returns None if the bytes are not a response packet.
+    """
+    (k, params, time) = _XID_PACKET.unpack(packet)
+
+    if k != b'k' or (params & INVALID_PORT_BITS) != 0:
+        return None
+
+    port = params & 0x0F
+    key = ((params & 0xE0) >> 5)
+    pressed = (params & KEY_RELEASE_BITMASK) == KEY_RELEASE_BITMASK
+
+    if key == 0:
+        key = 8
+
+    return (port, key, pressed, time)
+
+
+def parse_st2_packet(packet):
+    """
+    Decodes a 9 byte StimTracker 2 response packet into (port, key,
+    pressed, time). Returns None if the bytes are not a response packet.
+    """
+    (o, port, key, pressed, time, null_byte) = _ST2_PACKET.unpack(packet)
+
+    if o != b'o' or null_byte != 0:
+        return None
+
+    if key == 0:
+        key = 8
+
+    return (port, key, pressed == b'1', time)
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Pulse table compiler.
+
+A PulseTable is described per output line: pulse trains, one-shots and
+binary codes. Lines are numbered 1 to 16 as in XidDevice.activate_line(),
+line n being bit n - 1 of a mask. compile() merges the descriptions into the shortest list of
+(time, mask) entries that reproduces them, one entry per time at which
+any line changes, and upload() writes that list to a device's pulse
+table. The compiled table can be checked in software with state_at(),
+line_intervals() and render() before it goes near a device.
+
+Example:
+    table = PulseTable()
+    table.train(1, period=100, width=10, count=20)   # 10 Hz for 2 s
+    table.one_shot(2, at=500, width=50)
+    table.code(0x2A, at=1000, width=20, lines=range(9, 17))
+    table.upload(dev, run=True)
+
+All times are whole miliseconds from the start of the table, the
+resolution of the device's pulse table.
+"""
+from array import array
+from bisect import bisect_right
+
+LINE_COUNT = 16
+MAX_TIME = 0xFFFFFFFF
+# The device doesn't report how many entries its table holds, so the limit
+# is a PulseTable parameter and this is only its default
+MAX_ENTRIES = 256
+
+
+def _ms(value, name):
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError('%s must be a whole number of miliseconds, '
+                             'not %r' % (name, value))
+        value = int(value)
+
+    if not 0 <= value <= MAX_TIME:
+        raise ValueError('%s must be between 0 and %d ms, not %r' %
+                         (name, MAX_TIME, value))
+
+    return value
+
+
+def _line(line):
+    if line not in range(1, LINE_COUNT + 1):
+        raise ValueError('line must be between 1 and %d, not %r' %
+                         (LINE_COUNT, line))
+
+    return line
+
+
+def _bit(line):
+    return 1 << (line - 1)
+
+
+def state_at(entries, time):
+    """
+    The line mask a table of (time, mask) entries sets at time (ms)
+    """
+    index = bisect_right([t for (t, _) in entries], time)
+    return entries[index - 1][1] if index > 0 else 0
+
+
+def line_intervals(entries):
+    """
+    Simulates a table of (time, mask) entries and returns {line: [(start,
+    end), ...]}, the times each line is high. A line still high after the
+    last entry ends at MAX_TIME.
+    """
+    intervals = {}
+    mask = 0
+    for (time, new_mask) in entries:
+        changed = mask ^ new_mask
+        for line in range(1, LINE_COUNT + 1):
+            if changed & _bit(line):
+                if new_mask & _bit(line):
+                    intervals.setdefault(line, []).append([time, None])
+                else:
+                    intervals[line][-1][1] = time
+        mask = new_mask
+
+    return dict((line, [(start, MAX_TIME if end is None else end)
+                        for (start, end) in spans])
+                for (line, spans) in intervals.items())
+
+
+def render(entries, until, step=1):
+    """
+    Returns the line mask every step ms from 0 to until (exclusive) as an
+    array of 16 bit values, e.g. for plotting
+    """
+    samples = array('H')
+    mask = 0
+    for (time, new_mask) in entries:
+        if time >= until:
+            break
+        fill = (time - len(samples) * step + step - 1) // step
+        if fill > 0:
+            samples.extend([mask] * fill)
+        mask = new_mask
+
+    fill = (until - len(samples) * step + step - 1) // step
+    if fill > 0:
+        samples.extend([mask] * fill)
+
+    return samples
+
+
+class PulseTable(object):
+    """
+    Output line waveforms, compiled to the device's pulse table format.
+
+    Pulses on the same line may touch, in which case they merge into one,
+    but not overlap. compile() raises ValueError if they do, if a time is
+    not a whole number of miliseconds, or if the table needs more than
+    max_entries entries, counting the (0, 0) entry that ends it.
+    """
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        # (line, start, end, description)
+        self.__pulses = []
+
+    def __len__(self):
+        return len(self.compile())
+
+    def train(self, line, period, width, count, start=0):
+        """
+        count pulses of width ms on line, one every period ms from start
+        """
+        line = _line(line)
+        period = _ms(period, 'period')
+        width = _ms(width, 'width')
+        start = _ms(start, 'start')
+        if not 0 < width < period:
+            raise ValueError('width must be more than 0 and less than the '
+                             'period, not %r' % width)
+        if count <= 0:
+            raise ValueError('count must be more than 0, not %r' % count)
+
+        description = 'train on line %d at %d ms' % (line, start)
+        for i in range(count):
+            self.__add(line, start + i * period, width, description)
+
+    def one_shot(self, line, at, width):
+        """
+        A single pulse of width ms on line, at ms from the start
+        """
+        self.__add(_line(line), _ms(at, 'at'), _ms(width, 'width'),
+                   'one-shot on line %d at %r ms' % (line, at))
+
+    def code(self, value, at, width, lines=range(1, 9)):
+        """
+        value as a parallel binary code for width ms: lines lists the line
+        of each bit, least significant bit first, and the lines of the set
+        bits are raised
+        """
+        lines = [_line(line) for line in lines]
+        if not 0 <= value < (1 << len(lines)):
+            raise ValueError('%r does not fit on %d lines' %
+                             (value, len(lines)))
+
+        at = _ms(at, 'at')
+        width = _ms(width, 'width')
+        for (bit, line) in enumerate(lines):
+            if value & (1 << bit):
+                self.__add(line, at, width,
+                           'code %r at %d ms' % (value, at))
+
+    def serial_code(self, line, bits, at, bit_width):
+        """
+        bits (a string of '0' and '1', sent first to last) on a single line
+        from at ms, bit_width ms per bit
+        """
+        line = _line(line)
+        at = _ms(at, 'at')
+        bit_width = _ms(bit_width, 'bit_width')
+        if bit_width == 0:
+            raise ValueError('bit_width must be more than 0')
+
+        for (i, bit) in enumerate(bits):
+            if bit not in '01':
+                raise ValueError('bits must only contain 0 and 1, not %r' %
+                                 bits)
+            if bit == '1':
+                self.__add(line, at + i * bit_width, bit_width,
+                           'serial code %r at %d ms' % (bits, at))
+
+    def __add(self, line, start, width, description):
+        if width == 0:
+            raise ValueError('width must be more than 0')
+
+        self.__pulses.append((line, start, _ms(start + width, 'end'),
+                              description))
+
+    def clear(self):
+        self.__pulses = []
+
+    def bitmask(self):
+        """
+        The lines used by the table, for set_pulse_table_bitmask()
+        """
+        mask = 0
+        for (line, _, _, _) in self.__pulses:
+            mask |= _bit(line)
+
+        return mask
+
+    def intervals(self):
+        """
+        {line: [(start, end), ...]}, the sorted times each line is high, with
+        touching pulses merged
+        """
+        intervals = {}
+        for (line, start, end, description) in sorted(self.__pulses):
+            spans = intervals.setdefault(line, [])
+            if spans and start < spans[-1][1]:
+                raise ValueError('%s overlaps an earlier pulse on line %d '
+                                 '(%d to %d ms)' % (description, line,
+                                                    spans[-1][0],
+                                                    spans[-1][1]))
+            if spans and start == spans[-1][1]:
+                spans[-1] = (spans[-1][0], end)
+            else:
+                spans.append((start, end))
+
+        return intervals
+
+    def duration(self):
+        """
+        The time of the last change, in ms
+        """
+        return max([end for (_, _, end, _) in self.__pulses] or [0])
+
+    def compile(self):
+        """
+        Returns the table as a time-ordered list of (time, mask) entries,
+        with an entry only where the mask changes
+        """
+        changes = {}
+        for (line, spans) in self.intervals().items():
+            for (start, end) in spans:
+                changes[start] = changes.get(start, 0) ^ _bit(line)
+                changes[end] = changes.get(end, 0) ^ _bit(line)
+
+        entries = []
+        mask = 0
+        for time in sorted(changes):
+            mask ^= changes[time]
+            entries.append((time, mask))
+
+        # upload() adds the (0, 0) entry ending the table
+        if len(entries) + 1 > self.max_entries:
+            raise ValueError('The table needs %d entries including the one '
+                             'ending it, more than the %d allowed' % (
+                                 len(entries) + 1, self.max_entries))
+
+        return entries
+
+    def verify(self):
+        """
+        Simulates the compiled table and checks each line against the
+        descriptions. Returns True if they match.
+        """
+        return line_intervals(self.compile()) == self.intervals()
+
+    def upload(self, device, run=False):
+        """
+        Replaces the pulse table of device with this table, in a single
+        write: the table is cleared, the entries and the (0, 0) entry ending
+        the table are written and the bitmask is set to the lines used. The
+        table must not be running. Does nothing on XID 1 devices, which
+        have no pulse table.
+
+        Returns the compiled entries.
+        """
+        entries = self.compile()
+
+        batch = device.command_batch()
+        batch.clear_pulse_table()
+        for (time, mask) in entries:
+            batch.add_pulse_table_entry(time, mask)
+        batch.add_pulse_table_entry(0, 0x0000)
+        batch.set_pulse_table_bitmask(self.bitmask())
+        batch.execute()
+
+        if run:
+            device.run_pulse_table()
+
+        return entries
@@ -1,62 +1,163 @@
 # -*- coding: utf-8 -*-
-from struct import pack
-from struct import unpack
+import threading
+import time
 
-from .constants import NO_KEY_DETECTED
-from .internal import XidConnection
+from .constants import NO_KEY_DETECTED, IO_MODE_EVENT, IO_MODE_QUEUE, IO_MODE_TIMEOUT
+from .internal import (XidConnection, XidError, list_ftdi_devices, ConnectionProfile, LOW_LATENCY_PROFILE,
+                       BALANCED_PROFILE, THROUGHPUT_PROFILE,
+                       CONNECTION_PROFILES)
 from .keymaps import (rb_530_keymap, rb_730_keymap, rb_830_keymap,
-                      rb_834_keymap, lumina_keymap)
-
-import ftd2xx
+                      rb_834_keymap, lumina_keymap, map_key)
+from .response_filter import ResponseFilter
+from .batch import CommandBatch
+from .monitor import DeviceMonitor
+from .device_config import (DeviceConfig, DEFAULT_SELECTORS, SettingsCache,
+                            apply_config, write_settings)
+from . import commands
 
 class XidScanner(object):
     """
     Scan the computer for connected XID devices
     """
+    # Baud rates tried when nothing is known about a device
+    BAUD_RATES = [115200, 19200, 9600, 57600, 38400]
+    # Used while probing: a short latency timer gets the 5 byte '_c1' reply
+    # back quickly, so a rate the device doesn't use fails after
+    # read_timeout miliseconds instead of the usual 100.
+    PROBE_PROFILE = ConnectionProfile('probe', 1, read_timeout=20)
+
     def __init__(self):
         self.__xid_cons = []
+        # FTDI devices found not to be XID devices by earlier scans
+        self.__non_xid_devices = set()
+        # Baud rate each device (by serial or location, and by FTDI
+        # description) was last found at
+        self.__baud_history = {}
 
-    def detect_xid_devices(self):
+    def detect_xid_devices(self, incremental=False, baud_rate=None):
         """
         For all of the com ports connected to the computer, send an
         XID command '_c1'.  If the device response with '_xid', it is
         an xid device.
+
+        Baud rates are tried in the order given by baud_rate_order(). If
+        baud_rate is given, only that rate is tried.
+
+        With incremental=True only FTDI devices that were not there in the
+        previous scan are probed. Connections to devices that are still
+        attached are kept as they are (and stay open if they are open),
+        connections to devices that were unplugged are closed and dropped.
+        Devices are told apart by serial number, or USB location for
+        devices without one.
         """
-        for con in self.__xid_cons:
-            con.close()
+        device_list = list_ftdi_devices()
 
-        self.__xid_cons = []
+        if not incremental:
+            for con in self.__xid_cons:
+                con.close()
 
-        ftd_dev_num = ftd2xx.createDeviceInfoList()
+            self.__xid_cons = []
+            self.__non_xid_devices = set()
+
+        kept_cons = []
+        for con in self.__xid_cons:
+            for (i, device_info) in enumerate(device_list):
+                if con.matches(device_info):
+                    con.ftd2xx_index = i
+                    kept_cons.append(con)
+                    break
+            else:
+                con.close()
 
-        for i in range (0, ftd_dev_num):
-            device_found = False
-            for b in [115200, 19200, 9600, 57600, 38400]:
-                con = XidConnection(i, b)
+        self.__xid_cons = kept_cons
 
-                if con.open():
-                    con.flush()
-                
-                    try:
-                        returnval = con.send_xid_command("_c1", 5).decode('ASCII')
-                    except UnicodeDecodeError as e:
-                        # Assume this isn't an XID device, since it returned something weird.
-                        con.close()
-                        break
+        for i in range (0, len(device_list)):
+            device_info = device_list[i]
+            if any(con.matches(device_info) for con in self.__xid_cons) or \
+                    self.__device_key(device_info) in self.__non_xid_devices:
+                continue
 
-                    if returnval.startswith('_xid'):
-                        device_found = True
-                        self.__xid_cons.append(con)
+            if baud_rate is not None:
+                baud_rates = [baud_rate]
+            else:
+                baud_rates = self.baud_rate_order(device_info)
+
+            (con, non_xid) = self.__probe(i, device_info, baud_rates)
+            if con is not None:
+                self.__xid_cons.append(con)
+                self.__baud_history[self.__device_key(device_info)] = \
+                    con.baudrate
+                self.__baud_history[self.__description_key(device_info)] = \
+                    con.baudrate
+            elif non_xid:
+                # Only devices that answered as something else are skipped
+                # from now on. Devices that could not be opened (e.g. in use
+                # by another program) or did not answer at any rate (e.g.
+                # still powering up) are probed again next time.
+                self.__non_xid_devices.add(self.__device_key(device_info))
+
+    def baud_rate_order(self, device_info):
+        """
+        The order in which baud rates are tried for a device: the rate it
+        was found at before, then the rate the last device with the same
+        FTDI description (i.e. the same model) was found at, then the rest
+        of BAUD_RATES.
+        """
+        order = []
+        for key in (self.__device_key(device_info),
+                    self.__description_key(device_info)):
+            baud_rate = self.__baud_history.get(key)
+            if baud_rate is not None and baud_rate not in order:
+                order.append(baud_rate)
+
+        return order + [b for b in self.BAUD_RATES if b not in order]
+
+    def __device_key(self, device_info):
+        if device_info.get('serial'):
+            return ('serial', device_info['serial'])
+        return ('location', device_info.get('location'))
+
+    def __description_key(self, device_info):
+        return ('description', device_info.get('description'))
+
+    def __probe(self, i, device_info, baud_rates):
+        # Returns (con, non_xid): con is a closed XidConnection if the
+        # device at index i answers '_c1' at one of the baud rates and None
+        # otherwise, non_xid whether the device gave an answer that
+        # definitely isn't an XID device's.
+        for b in baud_rates:
+            con = XidConnection(i, b, self.PROBE_PROFILE, device_info)
+
+            if con.open():
+                con.flush()
+
+                try:
+                    returnval = con.send_xid_command("_c1", 5).decode('ASCII')
+                except UnicodeDecodeError as e:
+                    # Assume this isn't an XID device, since it returned something weird.
+                    con.close()
+                    return (None, True)
 
-                        if(returnval != '_xid0'):
-                            # set the device into XID mode
-                            con.send_xid_command('c10')
-                            con.flush()
+                if returnval.startswith('_xid'):
+                    if(returnval != '_xid0'):
+                        # set the device into XID mode
+                        con.send_xid_command('c10')
+                        con.flush()
 
                     con.close()
-                    if device_found:
-                        # Device found, we're done.
-                        break
+                    con.set_profile(None)
+                    # Device found, we're done.
+                    return (con, False)
+
+                con.close()
+
+                if len(returnval) == 5 and returnval.isprintable():
+                    # A full reply of readable text at this rate: some
+                    # other device talking, not line noise from a wrong
+                    # baud rate
+                    return (None, True)
+
+        return (None, False)
 
     def device_at_index(self, index):
         """
@@ -74,12 +175,26 @@ class XidScanner(object):
         return len(self.__xid_cons)
 
 
-class XidError(Exception):
-    pass
+# Commands XidDevice sends once a device has been identified:
+# put XID 1 devices in the output mode pyxid uses ('a10'),
+INIT_OUTPUT_MODE = 'output_mode'
+# set the digital output lines to their initial state,
+INIT_CLEAR_LINES = 'clear_lines'
+# and reset the timer.
+INIT_RESET_TIMER = 'reset_timer'
+DEFAULT_INIT_COMMANDS = (INIT_OUTPUT_MODE, INIT_CLEAR_LINES)
 
 
 class XidDevice(object):
-    def __init__(self, xid_connection):
+    # Longest single driver read done by wait_for_response(). Bounds how
+    # late a deadline can be noticed when no bytes arrive.
+    WAIT_SLICE_MS = 100
+
+    def __init__(self, xid_connection, init_commands=DEFAULT_INIT_COMMANDS):
+        """
+        Identifies the device on xid_connection and sends init_commands,
+        a sequence of the INIT_* constants, pipelined in a single write.
+        """
         self.con = xid_connection
         self._impl = None
         self.product_id = -1
@@ -88,19 +203,90 @@ class XidDevice(object):
         self.device_name = 'Uninitialized XID device'
         self.keymap = None
         self.response_queue = []
+        self._response_lock = threading.Lock()
+        self.settings_cache = SettingsCache()
+        self.reconnect_count = 0
+        # Set when the device is registered, see pyxid2.registry
+        self._registry = None
+        # A rescan may wrap the connection of a closed device in a new
+        # XidDevice. The connection is only closed by its latest owner.
+        self.__owner = object()
+        self.con.owner = self.__owner
         
         self.init_device()
 
         self.con.set_using_stim_tracker_output(self.major_fw_version == 2 or self.product_id == b'S')
         self.con.set_resp_packet_size(self.major_fw_version == 2 and self.product_id == b'S')
-        if self.major_fw_version == 1:
-            self.con.send_xid_command('a10')
-        self.con.clear_digital_output_lines(0xff)
+
+        batch = self.command_batch()
+        if INIT_OUTPUT_MODE in init_commands and self.major_fw_version == 1:
+            batch.send('a10')
+        if INIT_CLEAR_LINES in init_commands:
+            # The same as self.con.clear_digital_output_lines(0xff)
+            batch.send(self.con.digital_output_lines_command(0xff00))
+        if INIT_RESET_TIMER in init_commands:
+            batch.send('e5')
+        batch.execute()
 
     def __del__(self):
-        self.con.close()
+        self._close_connection()
         del self.con
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Gives up a reference to the device taken by open_xid_device() and
+        closes the connection if it was the last one (or if the device was
+        never opened that way). Returns True if the connection was closed.
+        """
+        if self._registry is not None:
+            return self._registry.release(self)
+
+        return self._close_connection()
+
+    def _close_connection(self):
+        # Leaves the connection alone if a newer XidDevice took it over
+        if self.con.owner is not self.__owner:
+            return False
+
+        self.con.close()
+        return True
+
+    def reconnect(self, device_list=None):
+        """
+        Reopens the connection after the device was unplugged and plugged
+        back in, without rescanning: the device is found by its serial
+        number or USB location and opened at the baud rate it had. The
+        digital output lines and the settings in the settings cache are
+        written to the device again. See DeviceMonitor to do this
+        automatically.
+
+        Responses made while the device was disconnected are lost, and the
+        device's timer restarted when it was powered up again.
+
+        Returns True if the device was reconnected.
+        """
+        if not self.con.reopen(device_list):
+            return False
+
+        if self.major_fw_version == 1:
+            self.con.send_xid_command('a10')
+        self.con.restore_output_lines()
+
+        settings = dict(self.settings_cache.values)
+        self.settings_cache.invalidate()
+        if settings:
+            write_settings(self, settings)
+
+        self.reconnect_count += 1
+
+        return True
+
     def reset_timer(self):
         """
         Resets the timer.
@@ -119,7 +305,7 @@ class XidDevice(object):
             # and 'e3' for query (returns e3 followed by 4 bytes of timestamp)
             time = 0
         else:
-            (_, _, _, time) = unpack('<cccI', self.con.send_xid_command("_e5", 7))
+            time = self._query(commands.timer_query())
         
         return time
 
@@ -154,9 +340,12 @@ class XidDevice(object):
         """
         Initializes the device with the proper keymaps and name
         """
-        self.product_id = self._send_command('_d2', 1)
-        self.model_id = self._send_command('_d3', 1)
-        self.major_fw_version = int(self._send_command('_d4', 1))
+        batch = self.command_batch()
+        batch.query(commands.product_id_query())
+        batch.query(commands.model_id_query())
+        batch.query(commands.major_fw_version_query())
+        (self.product_id, self.model_id, self.major_fw_version) = \
+            batch.execute()
 
         if self.product_id == b'0':
             self.device_name = 'Cedrus Lumina 3G' if self.major_fw_version == 2 else 'Cedrus Lumina LP-400'
@@ -212,6 +401,73 @@ class XidDevice(object):
 
         return response
 
+    def _query(self, query):
+        """
+        Send a commands.Query to the device and decode its reply
+        """
+        reply = self.con.send_xid_byte_command(query.command,
+                                               query.bytes_expected)
+        if len(reply) < query.bytes_expected:
+            raise XidError('No reply to %r from %s' % (query.command,
+                                                        self.device_name))
+
+        return query.decode(reply)
+
+    def _cached_query(self, key, query, force_refresh):
+        """
+        Returns the setting from the settings cache, or sends the query and
+        caches its result on a miss or when force_refresh is True.
+        """
+        if not force_refresh:
+            (found, value) = self.settings_cache.lookup(key)
+            if found:
+                return value
+
+        value = self._query(query)
+        self.settings_cache.put(key, value)
+
+        return value
+
+    def invalidate_settings_cache(self):
+        """
+        Forgets all cached settings, so the next getter calls query the
+        device. Call this if the device was configured by other means,
+        e.g. with Xidon.
+        """
+        self.settings_cache.invalidate()
+
+    def settings_cache_stats(self):
+        """
+        Returns a dict with the settings cache 'hits', 'misses' and 'size'
+        """
+        return self.settings_cache.stats()
+
+    def command_batch(self):
+        """
+        Returns a CommandBatch that queues commands for this device and
+        sends them together with execute(). See CommandBatch.
+        """
+        return CommandBatch(self)
+
+    def read_config(self, selectors=DEFAULT_SELECTORS):
+        """
+        Returns a DeviceConfig snapshot of the device's settings for the
+        given input selectors, read in one pipelined pass.
+        """
+        return DeviceConfig.read(self, selectors)
+
+    def apply_config(self, target, save_to_flash=False, current=None):
+        """
+        Brings the device to the target DeviceConfig (or dict of settings),
+        writing only the settings that differ from the device's current
+        state. Pass a snapshot from read_config() as current to skip reading
+        the device first. save_to_flash() is called if anything was written
+        and save_to_flash is True.
+
+        Returns a dict with the number of settings 'written' and 'skipped'.
+        """
+        return apply_config(self, target, current, save_to_flash)
+
     def poll_for_response(self):
         """
         Polls the device for user input
@@ -223,18 +479,99 @@ class XidDevice(object):
         If a response is waiting to be processed, the response is appended
         to the internal response_queue
         """
-        key_state = self.con.check_for_keypress()
+        self.con.check_for_keypress()
+
+        # Responses may also have been parsed while reading command replies
+        self._queue_parsed_responses()
+
+    def _queue_parsed_responses(self):
+        if self.con.pending_response_count() == 0:
+            return
+
+        responses = self.con.get_pending_responses()
+        for response in responses:
+            response['key'] = map_key(self.keymap, response['port'],
+                                      response['key'])
+
+        with self._response_lock:
+            self.response_queue.extend(responses)
+
+    def _pop_response(self, predicate=None):
+        with self._response_lock:
+            for i, response in enumerate(self.response_queue):
+                if predicate is None or predicate(response):
+                    return self.response_queue.pop(i)
+
+        return None
+
+    def wait_for_response(self, timeout=None, predicate=None, deadline=None):
+        """
+        Waits until a response is available and returns it, or returns None
+        if none arrived in time.
+
+        Instead of spinning on poll_for_response(), this blocks inside the
+        driver read until bytes arrive, waking up at most every
+        WAIT_SLICE_MS miliseconds to check the deadline.
 
-        if key_state != NO_KEY_DETECTED:
-            response = self.con.get_current_response()
+            timeout:   Maximum time to wait in miliseconds. None waits
+                       forever (or until deadline).
+            predicate: Optional function taking a response dict. Only
+                       responses for which it returns True are returned;
+                       other responses stay in the response queue.
+            deadline:  Absolute time.perf_counter() value (in seconds) at
+                       which to give up. The earlier of timeout and deadline
+                       is used.
+
+        Example: wait up to 2 seconds for a key press
+            response = dev.wait_for_response(2000, lambda r: r['pressed'])
+        """
+        if timeout is not None:
+            timeout_deadline = time.perf_counter() + timeout / 1000.0
+            if deadline is None or timeout_deadline < deadline:
+                deadline = timeout_deadline
 
-            if response['port'] == 0:
-                if self.keymap is not None:
-                    response['key'] = self.keymap[response['key']]
-                else:
-                    response['key'] -= 1
+        while True:
+            self._queue_parsed_responses()
+            response = self._pop_response(predicate)
+            if response is not None:
+                return response
 
-            self.response_queue.append(response)
+            read_timeout = self.WAIT_SLICE_MS
+            if deadline is not None:
+                remaining = (deadline - time.perf_counter()) * 1000.0
+                if remaining <= 0:
+                    return None
+                read_timeout = max(1, min(read_timeout, int(remaining)))
+
+            self.con.check_for_keypress(read_timeout)
+
+    def set_response_filter(self, response_filter=None):
+        """
+        Installs a ResponseFilter that drops unwanted responses before they
+        reach the response queue, e.g. key releases, unused ports or keys,
+        and bounces within a minimum interval. Pass None to remove it.
+
+        Example:
+            dev.set_response_filter(ResponseFilter(ports=[0], pressed=True))
+        """
+        if response_filter is not None:
+            response_filter.keymap = self.keymap
+
+        self.con.set_response_filter(response_filter)
+
+    def record_responses(self, recorder=None, queue=True):
+        """
+        Records every response into recorder as it is parsed, e.g. into a
+        columnar.ResponseColumns for export to pandas, Arrow or Parquet.
+        The device's keymap is applied as in poll_for_response(). Responses
+        are also put in the response queue unless queue is False, which
+        saves building a dict for each of them in long sessions that only
+        need the recording. Pass None to stop recording.
+        """
+        if recorder is not None:
+            recorder.keymap = self.keymap
+
+        self.con.set_response_recorder(recorder, queue)
 
     def response_queue_size(self):
         """
@@ -268,15 +605,64 @@ class XidDevice(object):
                       report the value of the RT timer in miliseconds.
         """
         response = None
-        if self.has_response():
-            response = self.response_queue.pop(0)
+        with self._response_lock:
+            if self.has_response():
+                response = self.response_queue.pop(0)
         return response
 
     def clear_response_queue(self):
         """
         Clears the response queue
         """
-        self.response_queue = []
+        with self._response_lock:
+            self.response_queue = []
+
+    def collect_trial(self, window_ms, max_responses=None, keys=None,
+                      include_releases=False, reset_timer=True):
+        """
+        Starts a trial and collects its responses.
+
+        At the start, the driver's receive buffer is purged, the response
+        queue cleared and (if reset_timer is True) the timer reset, all in
+        one step with a single write, instead of separate
+        flush_serial_buffer(), clear_response_queue() and reset_timer()
+        calls. Call it right at stimulus onset.
+
+        Responses are then collected until window_ms miliseconds have
+        passed or max_responses were collected. Only key presses count,
+        plus releases if include_releases is True, and only of the given
+        keys if keys is given. Other responses are discarded.
+
+        Returns a dict with:
+            'responses':         the collected response dicts
+            'onset':             time.perf_counter() time the trial started
+                                 (when the timer reset was sent)
+            'onset_overhead_ms': how long starting the trial took
+            'complete':          True if max_responses were collected
+        """
+        start = time.perf_counter()
+        onset = self.con.flush_then_write(b'e5' if reset_timer else b'', 1)
+        with self._response_lock:
+            self.response_queue = []
+
+        def counts(response):
+            return (response['pressed'] or include_releases) and \
+                (keys is None or response['key'] in keys)
+
+        deadline = onset + window_ms / 1000.0
+        responses = []
+        while max_responses is None or len(responses) < max_responses:
+            response = self.wait_for_response(deadline=deadline)
+            if response is None:
+                break
+            if counts(response):
+                responses.append(response)
+
+        return {'responses': responses,
+                'onset': onset,
+                'onset_overhead_ms': (onset - start) * 1000.0,
+                'complete': max_responses is not None and
+                    len(responses) >= max_responses}
 
     # Will flush both input and output buffers by default.
     # 1 is output (from device) only, 2 is input (to device) only
@@ -288,14 +674,18 @@ class XidDevice(object):
         Sets the pulse duration for events in miliseconds when activate_line
         is called
         """
-        command = pack('<ccI', b'm', b'p', duration)
-
-        self.con.send_xid_byte_command(command, 0)
+        self.con.send_xid_byte_command(
+            commands.pulse_duration_command(duration), 0)
+        self.settings_cache.put('pulse_duration', duration)
 
-    def get_pulse_duration(self):
-        (_, _, _, duration) = unpack('<cccI', self.con.send_xid_command("_mp", 7))
-
-        return duration
+    def get_pulse_duration(self, force_refresh=False):
+        """
+        Gets the pulse duration. Like the other settings getters, this
+        returns the value last written or read unless force_refresh is True.
+        """
+        return self._cached_query('pulse_duration',
+                                  commands.pulse_duration_query(),
+                                  force_refresh)
 
     def activate_line(self, lines=None, bitmask=None, leave_remaining_lines=False):
         """
@@ -345,7 +735,7 @@ class XidDevice(object):
             raise ValueError('Can only set one of lines or bitmask')
 
         if bitmask is not None:
-            if bitmask not in list(range(0, 65536)):
+            if bitmask not in range(0, 65536):
                 raise ValueError('bitmask must be an integer between '
                                  '0 and 65535')
 
@@ -360,7 +750,8 @@ class XidDevice(object):
                                      '(inclusive)')
                 bitmask |= 2 ** (l-1)
 
-        self.con.set_digital_output_lines(bitmask, leave_remaining_lines)
+        return self.con.set_digital_output_lines(bitmask,
+                                                 leave_remaining_lines)
 
     def clear_line(self, lines=None, bitmask=None, leave_remaining_lines=False):
         """
@@ -374,7 +765,7 @@ class XidDevice(object):
             raise ValueError('Can only set one of lines or bitmask')
 
         if bitmask is not None:
-            if bitmask not in list(range(0, 65536)):
+            if bitmask not in range(0, 65536):
                 raise ValueError('bitmask must be an integer between '
                                  '0 and 65535')
 
@@ -389,62 +780,145 @@ class XidDevice(object):
                                      '(inclusive)')
                 bitmask |= 2 ** (l-1)
 
-        self.con.clear_digital_output_lines(bitmask, leave_remaining_lines)
+        return self.con.clear_digital_output_lines(bitmask,
+                                                   leave_remaining_lines)
+
+    def coalesce_lines(self):
+        """
+        Returns a context manager within which activate_line() and
+        clear_line() only update the line state; the final state is
+        written to the device once, when the block ends or at
+        commit_lines(). The number of writes saved is counted in
+        con.stats.line_writes_avoided.
+
+        Example: raise lines 1, 3 and 5 with a single write
+            with dev.coalesce_lines():
+                for line in (1, 3, 5):
+                    dev.activate_line(lines=line, leave_remaining_lines=True)
+        """
+        return self.con.coalesced_output_lines()
+
+    def commit_lines(self):
+        """
+        Writes the line state built up by coalesce_lines() or the
+        coalescing window now. Returns True if anything was written.
+        """
+        return self.con.commit_output_lines()
+
+    def set_line_coalescing_window(self, window):
+        """
+        Combines activate_line() and clear_line() calls made within window
+        miliseconds of the first one into a single write at the end of the
+        window. 0 turns this off.
+        """
+        self.con.set_coalescing_window(window)
 
     def set_lines(self, lines):
-        self.con.set_digio_lines_to_mask(lines)
+        return self.con.set_digio_lines_to_mask(lines)
 
     def clear_all_lines(self):
-        self.con.set_digio_lines_to_mask(0)
+        return self.con.set_digio_lines_to_mask(0)
+
+    def start_output_writer(self):
+        """
+        Makes marker output non-blocking: activate_line(), clear_line(),
+        set_lines() and every other command are queued to a writer thread,
+        in order, and the marker methods return a WriteHandle right away.
+        handle.sent is the time.perf_counter() time the driver accepted
+        the command, once handle.done(); handle.wait() waits for that.
+        Commands with replies still wait for their reply.
+
+        Example:
+            dev.start_output_writer()
+            handle = dev.activate_line(lines=1)   # at flip time
+            ...
+            handle.wait()
+            print(handle.sent - flip_time)
+        """
+        self.con.start_writer()
+
+    def stop_output_writer(self):
+        """
+        Writes the commands still queued and makes writes blocking again
+        """
+        self.con.stop_writer()
+
+    def send_marker_burst(self, masks, hold=0):
+        """
+        Sets the output lines to each bitmask in masks in turn, e.g. to send
+        a trial code spread over several words. masks is a list of ints or
+        a NumPy uint16 array.
+
+        On StimTracker and XID 2 devices, with no hold time, the whole burst
+        goes out in one USB write. With a hold time each mask stays on the
+        lines for hold miliseconds, written directly even when the output
+        writer is on. Set the pulse duration to 0 (see
+        set_pulse_duration()) or longer than the hold time, so lines aren't
+        lowered in between.
+
+        Returns a dict with the number of 'markers', the driver 'writes'
+        made, the 'seconds' the burst took and the 'markers_per_second'.
+        """
+        start = time.perf_counter()
+        writes = self.con.set_digital_output_lines_burst(masks, hold)
+        seconds = time.perf_counter() - start
+
+        return {'markers': len(masks),
+                'writes': writes,
+                'seconds': seconds,
+                'markers_per_second': len(masks) / seconds if seconds else 0.0}
 
     def save_to_flash(self):
         if self.major_fw_version < 2:
             return
 
         self.con.send_xid_command("f9")
+        self.settings_cache.invalidate()
 
     # '_ia'
     # Example: get_single_shot('K')
-    def get_single_shot(self, selector):
+    def get_single_shot(self, selector, force_refresh=False):
         if self.major_fw_version < 2:
             return
-        (_, _, _, _, action, delay) = unpack('<cccccI', self.con.send_xid_command("_ia%s" % selector, 9))
-
-        return (action == b'1', delay)
+        return self._cached_query(('single_shot', selector),
+                                  commands.single_shot_query(selector),
+                                  force_refresh)
 
     # 'ia'
     # Example: set_single_shot('K', True, 150)
     def set_single_shot(self, selector, action, delay):
-        command = pack('<ccccI', b'i', b'a', selector.encode('latin1'), b'1' if action is True else b'0', delay)
-
-        self.con.send_xid_byte_command(command, 0)
+        self.con.send_xid_byte_command(
+            commands.single_shot_command(selector, action, delay), 0)
+        self.settings_cache.put(('single_shot', selector),
+                                (action is True, delay))
 
     # '_if'
     # Example: get_signal_filter('K')
-    def get_signal_filter(self, selector):
+    def get_signal_filter(self, selector, force_refresh=False):
         if self.major_fw_version < 2:
             return
-        (_, _, _, _, holdOn, holdOff) = unpack('<ccccII', self.con.send_xid_command("_if%s" % selector, 12))
-
-        return (holdOn, holdOff)
+        return self._cached_query(('signal_filter', selector),
+                                  commands.signal_filter_query(selector),
+                                  force_refresh)
 
     # 'if'
     # Example: set_signal_filter('K', 100, 200)
     def set_signal_filter(self, selector, holdOn, holdOff):
         if self.major_fw_version < 2:
             return
-        command = pack('<cccII', b'i', b'f', selector.encode('latin1'), holdOn, holdOff)
-
-        self.con.send_xid_byte_command(command, 0)
+        self.con.send_xid_byte_command(
+            commands.signal_filter_command(selector, holdOn, holdOff), 0)
+        self.settings_cache.put(('signal_filter', selector),
+                                (holdOn, holdOff))
 
     # '_io'
     # Example: get_enable_digital_output('M')
-    def get_enable_digital_output(self, selector):
+    def get_enable_digital_output(self, selector, force_refresh=False):
         if self.major_fw_version < 2:
             return
-        (_, _, _, _, enabled) = unpack('<ccccc', self.con.send_xid_command("_io%s" % selector, 5))
-
-        return enabled == b'1'
+        return self._cached_query(
+            ('digital_output', selector),
+            commands.enable_digital_output_query(selector), force_refresh)
 
     # 'io'
     # Example: set_enable_digital_output('M', False)
@@ -452,17 +926,18 @@ class XidDevice(object):
         if self.major_fw_version < 2:
             return
 
-        command = 'io%s%s' % (selector, '1' if enable is True else '0')
-        self.con.send_xid_command(command, 0)
+        self.con.send_xid_byte_command(
+            commands.enable_digital_output_command(selector, enable), 0)
+        self.settings_cache.put(('digital_output', selector), enable is True)
 
     # '_iu'
     # Example: get_enable_usb_output('M')
-    def get_enable_usb_output(self, selector):
+    def get_enable_usb_output(self, selector, force_refresh=False):
         if self.major_fw_version < 2:
             return
-        (_, _, _, _, enabled) = unpack('<ccccc', self.con.send_xid_command("_iu%s" % selector, 5))
-
-        return enabled == b'1'
+        return self._cached_query(('usb_output', selector),
+                                  commands.enable_usb_output_query(selector),
+                                  force_refresh)
 
     # 'iu'
     # Example: set_enable_usb_output('M', False)
@@ -470,17 +945,18 @@ class XidDevice(object):
         if self.major_fw_version < 2:
             return
 
-        command = 'iu%s%s' % (selector, '1' if enable is True else '0')
-        self.con.send_xid_command(command, 0)
+        self.con.send_xid_byte_command(
+            commands.enable_usb_output_command(selector, enable), 0)
+        self.settings_cache.put(('usb_output', selector), enable is True)
 
     # '_ip'
     # Example: is_input_paused()
-    def is_input_paused(self):
+    def is_input_paused(self, force_refresh=False):
         if self.major_fw_version < 2:
             return
-        (_, _, _, paused) = unpack('<cccc', self.con.send_xid_command("_ip", 4))
-
-        return paused == b'0'
+        return self._cached_query('input_paused',
+                                  commands.input_paused_query(),
+                                  force_refresh)
 
     # 'ip'
     # Example: pause_output(True)
@@ -488,31 +964,34 @@ class XidDevice(object):
         if self.major_fw_version < 2:
             return
 
-        command = 'ip%s' % ('0' if pause is True else '1')
-        self.con.send_xid_command(command, 0)
+        self.con.send_xid_byte_command(commands.pause_output_command(pause), 0)
+        self.settings_cache.put('input_paused', pause is True)
 
-    def get_pulse_table_bitmask(self):
+    def get_pulse_table_bitmask(self, force_refresh=False):
         lines = 0
         if self.major_fw_version > 1:
-            (_, _, _, lines) = unpack('<cccH', self.con.send_xid_command("_mk", 5))
+            lines = self._cached_query('pulse_table_bitmask',
+                                       commands.pulse_table_bitmask_query(),
+                                       force_refresh)
 
         return lines
 
     def set_pulse_table_bitmask(self, mask):
-        ptable_mask = pack('<ccH', b'm', b'k', mask)
         if self.major_fw_version > 1:
-            self.con.send_xid_byte_command(ptable_mask)
+            self.con.send_xid_byte_command(
+                commands.pulse_table_bitmask_command(mask))
+            self.settings_cache.put('pulse_table_bitmask', mask)
 
     def clear_pulse_table(self):
         if self.major_fw_version > 1:
             self.con.send_xid_command("mc")
 
     def is_pulse_table_running(self):
-        running = -1
+        running = False
         if self.major_fw_version > 1:
-            (_, _, _, running) = unpack('<cccc', self.con.send_xid_command("_mr", 4))
+            running = self._query(commands.pulse_table_running_query())
 
-        return running == b'1'
+        return running
 
     def run_pulse_table(self):
         if self.major_fw_version > 1:
@@ -523,13 +1002,14 @@ class XidDevice(object):
             self.con.send_xid_command("ms")
 
     def add_pulse_table_entry(self, time, mask):
-        ptable_mask = pack('<ccIH', b'm', b't', time, mask)
         if self.major_fw_version > 1:
-            self.con.send_xid_byte_command(ptable_mask)
+            self.con.send_xid_byte_command(
+                commands.pulse_table_entry_command(time, mask))
 
     def reset_output_lines(self):
         if self.major_fw_version > 1:
             self.con.send_xid_command("mz")
+            self.settings_cache.invalidate()
 
     def __getattr__(self, attrname):
         return getattr(self._impl, attrname)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+The registry of open devices shared by everything in the process that uses
+pyxid2, so a toolbox and the experiment script driving it get the same
+XidDevice (and the single FTDI handle behind it) rather than closing each
+other's connections.
+
+Example:
+    with pyxid2.open_xid_device(serial='FT4ABCDE') as dev:
+        dev.activate_line(lines=1)
+"""
+import threading
+import weakref
+
+
+def _keys(con):
+    keys = []
+    if con.serial:
+        keys.append(('serial', con.serial))
+    if con.location is not None:
+        keys.append(('location', con.location))
+    return keys
+
+
+def _key(serial=None, location=None):
+    if serial:
+        if not isinstance(serial, bytes):
+            serial = serial.encode('latin1')
+        return ('serial', serial)
+    if location is not None:
+        return ('location', location)
+
+    raise ValueError('A serial number or location is required')
+
+
+class DeviceRegistry(object):
+    """
+    Process-wide table of the open XidDevices, keyed by FTDI serial number
+    and USB location, so code that needs a device can find the one that
+    is already open instead of scanning and opening it again.
+
+    Devices handed out by acquire() are reference counted: each holder
+    calls device.close() (or uses the device as a context manager) when
+    done, and the connection is closed when the last one does. Devices that
+    were never acquired are only weakly referenced.
+    """
+    def __init__(self):
+        self.__lock = threading.RLock()
+        self.__devices = weakref.WeakValueDictionary()
+        # id(device) -> [device, reference count]
+        self.__references = {}
+
+    def register(self, device):
+        with self.__lock:
+            for key in _keys(device.con):
+                self.__devices[key] = device
+            device._registry = self
+
+    def lookup(self, serial=None, location=None):
+        """
+        Returns the open device with the given serial number (str or bytes)
+        or USB location, or None
+        """
+        device = self.__devices.get(_key(serial, location))
+        if device is not None and device.con.ftd2xx_con != 0:
+            return device
+
+        return None
+
+    def lookup_connection(self, con):
+        """
+        Returns the open device on the same FTDI device as con, or None
+        """
+        for key in _keys(con):
+            device = self.__devices.get(key)
+            if device is not None and device.con.ftd2xx_con != 0:
+                return device
+
+        return None
+
+    def acquire(self, device):
+        """
+        Counts a reference to device and returns it
+        """
+        with self.__lock:
+            entry = self.__references.setdefault(id(device), [device, 0])
+            entry[1] += 1
+
+        return device
+
+    def release(self, device):
+        """
+        Drops a reference to device, closing it if it was the last one (or
+        if it was never acquired). Returns True if the device was closed.
+        """
+        with self.__lock:
+            entry = self.__references.get(id(device))
+            if entry is not None and entry[1] > 1:
+                entry[1] -= 1
+                return False
+
+            self.__references.pop(id(device), None)
+            for key in _keys(device.con):
+                if self.__devices.get(key) is device:
+                    del self.__devices[key]
+
+        return device._close_connection()
+
+    def reference_count(self, device):
+        entry = self.__references.get(id(device))
+        return entry[1] if entry is not None else 0
+
+    def devices(self):
+        """
+        The registered devices that are open
+        """
+        with self.__lock:
+            devices = []
+            for device in self.__devices.values():
+                if device.con.ftd2xx_con != 0 and \
+                        not any(device is d for d in devices):
+                    devices.append(device)
+
+            return devices
+
+    def close_all(self):
+        """
+        Closes every registered device, whatever its reference count
+        """
+        with self.__lock:
+            devices = self.devices()
+            self.__references = {}
+            self.__devices = weakref.WeakValueDictionary()
+
+        for device in devices:
+            device._close_connection()
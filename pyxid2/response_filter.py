@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from .keymaps import map_key
+from .parsers import port_number
+
+
+class ResponseFilter(object):
+    """
+    Declarative filter for responses coming from an XID device.
+
+    The filter is applied by the connection while it parses the serial
+    buffer, before a response dict is ever created or added to the
+    response queue. Rejected events cost nothing beyond the unpack.
+
+        ports:        Iterable of ports to accept. None accepts all ports.
+        keys:         Iterable of keys to accept, using the same 0 based
+                      numbering as get_next_response(). None accepts all.
+        pressed:      True to accept only key presses, False to accept
+                      only key releases, None to accept both.
+        min_interval: Minimum time in miliseconds (device time) between
+                      two accepted events (press or release) on the same
+                      key; anything the key does within that time of the
+                      last accepted event is contact bounce. Either a
+                      single value for all keys or a dict mapping key to
+                      interval.
+
+    The number of events dropped by each rule is kept in drop_counts.
+
+    Example:
+        dev.set_response_filter(ResponseFilter(pressed=True, min_interval=20))
+    """
+    def __init__(self, ports=None, keys=None, pressed=None, min_interval=0):
+        self.ports = None if ports is None else frozenset(ports)
+        self.keys = None if keys is None else frozenset(keys)
+        self.pressed = pressed
+        self.min_interval = min_interval
+        self.keymap = None
+        self.accepted = 0
+        self.drop_counts = {'port': 0,
+                            'key': 0,
+                            'pressed': 0,
+                            'debounce': 0}
+        self.__last_times = {}
+
+    def accept(self, port, key, pressed, time):
+        """
+        Returns True if the event should be queued. key is the raw key
+        number reported by the device.
+        """
+        port = port_number(port)
+        if self.ports is not None and port not in self.ports:
+            self.drop_counts['port'] += 1
+            return False
+
+        if self.pressed is not None and pressed != self.pressed:
+            self.drop_counts['pressed'] += 1
+            return False
+
+        key = map_key(self.keymap, port, key)
+
+        if self.keys is not None and key not in self.keys:
+            self.drop_counts['key'] += 1
+            return False
+
+        if isinstance(self.min_interval, dict):
+            interval = self.min_interval.get(key, 0)
+        else:
+            interval = self.min_interval
+
+        if interval > 0:
+            last_time = self.__last_times.get((port, key))
+            # A reset of the device timer makes time go backwards, in which
+            # case the event is never treated as a bounce.
+            if last_time is not None and 0 <= time - last_time < interval:
+                self.drop_counts['debounce'] += 1
+                return False
+            self.__last_times[(port, key)] = time
+
+        self.accepted += 1
+        return True
+
+    def dropped(self):
+        """
+        Total number of events dropped by all rules
+        """
+        return sum(self.drop_counts.values())
+
+    def reset_counts(self):
+        """
+        Resets the drop counters and the debounce history
+        """
+        self.accepted = 0
+        for rule in self.drop_counts:
+            self.drop_counts[rule] = 0
+        self.__last_times = {}
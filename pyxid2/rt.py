@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Online reaction times: pairs stimulus anchors with the responses that
+follow them and keeps running statistics per condition, in constant memory
+per condition however many trials there are.
+
+Example:
+    engine = RTEngine(dev, window_ms=2000)
+    engine.reset_timer()
+    for trial in trials:
+        engine.marker(trial.condition, lines=1)   # stimulus onset
+        show_stimulus(trial)
+        engine.update(timeout=2000)
+    print(engine.summary())
+"""
+import collections
+import time
+
+from .calibration import sync_device_clock
+
+
+class P2Quantile(object):
+    """
+    Estimates the p quantile of a stream of values without storing them,
+    with the P-square algorithm (Jain and Chlamtac, 1985): five markers
+    are kept whose heights follow the quantile as values arrive.
+    """
+    def __init__(self, p):
+        if not 0 < p < 1:
+            raise ValueError('p must be between 0 and 1')
+
+        self.p = p
+        self.count = 0
+        self.__heights = []
+        self.__positions = [1, 2, 3, 4, 5]
+        self.__desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.__increments = [0, p / 2.0, p, (1 + p) / 2.0, 1]
+
+    def add(self, value):
+        self.count += 1
+        heights = self.__heights
+
+        if self.count <= 5:
+            heights.append(value)
+            heights.sort()
+            return
+
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+
+        positions = self.__positions
+        for i in range(cell + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.__desired[i] += self.__increments[i]
+
+        for i in range(1, 4):
+            offset = self.__desired[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or \
+                    (offset <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if offset > 0 else -1
+                height = self.__parabolic(i, step)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + step * \
+                        (heights[i + step] - heights[i]) / \
+                        float(positions[i + step] - positions[i])
+                heights[i] = height
+                positions[i] += step
+
+    def __parabolic(self, i, step):
+        q = self.__heights
+        n = self.__positions
+        return q[i] + step / float(n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) /
+            float(n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) /
+            float(n[i] - n[i - 1]))
+
+    def value(self):
+        """
+        The current estimate, None before any values were added. Exact for
+        up to five values.
+        """
+        if self.count == 0:
+            return None
+        if self.count <= 5:
+            heights = self.__heights
+            return heights[min(len(heights) - 1,
+                               int(round(self.p * (len(heights) - 1))))]
+
+        return self.__heights[2]
+
+
+class RunningStats(object):
+    """
+    Count, mean and variance (Welford's algorithm), minimum, maximum and
+    P-square quantile estimates of a stream of values.
+    """
+    def __init__(self, quantiles=(0.5, 0.9)):
+        self.count = 0
+        self.mean = 0.0
+        self.__m2 = 0.0
+        self.min = None
+        self.max = None
+        self.quantiles = dict((p, P2Quantile(p)) for p in quantiles)
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.__m2 += delta * (value - self.mean)
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        for quantile in self.quantiles.values():
+            quantile.add(value)
+
+    @property
+    def variance(self):
+        """
+        The sample variance, 0 for fewer than two values
+        """
+        if self.count < 2:
+            return 0.0
+        return self.__m2 / (self.count - 1)
+
+    def to_dict(self):
+        result = {'count': self.count,
+                  'mean': self.mean if self.count else None,
+                  'sd': self.variance ** 0.5,
+                  'min': self.min,
+                  'max': self.max}
+        for (p, quantile) in self.quantiles.items():
+            result['q%g' % (p * 100)] = quantile.value()
+
+        return result
+
+
+class RTEngine(object):
+    """
+    Pairs anchors (stimulus onsets, in device time) with the responses that
+    follow them within window_ms, and keeps RunningStats of the reaction
+    times for each condition.
+
+    Anchors are set with reset_timer() (device time 0), marker() (device
+    time estimated from the host clock, lined up with the device's timer by
+    reset_timer(), plus marker_offset_ms, e.g. the offset_ms of a
+    calibration), or anchor() with a device time. On XID 1 devices the
+    timer can't be queried to line the clocks up, so marker() anchors are
+    early by the latency of the timer reset's write. On other devices the
+    two clocks drift apart, so update() lines them up again once
+    resync_interval seconds have passed since the last time (None never
+    does); clock_status() reports how long ago that was and the error it
+    left.
+
+    A matching response is paired with the newest open anchor before it,
+    giving that anchor's reaction time. Older open anchors, and anchors
+    whose window closes without a response, count as misses.
+    accept(response) decides which responses count, by default key presses
+    on port 0.
+
+    Responses are read from the device by update(), or passed in with
+    process() by code that reads them itself.
+    """
+    def __init__(self, device, window_ms=2000, quantiles=(0.5, 0.9),
+                 marker_offset_ms=0.0, accept=None, resync_interval=10.0):
+        self.device = device
+        self.window_ms = window_ms
+        self.quantiles = quantiles
+        self.marker_offset_ms = marker_offset_ms
+        self.resync_interval = resync_interval
+        self.accept = accept or (lambda response: response['pressed'] and
+                                 response['port'] == 0)
+        self.stats = {}
+        self.misses = collections.Counter()
+        # Responses that fell in no open window
+        self.unpaired = 0
+        self.__anchors = collections.deque()
+        self.__timer_zero = None
+        # perf_counter() time and error bound (ms) of the last clock sync
+        self.__synced_at = None
+        self.__sync_error_ms = None
+        self.__syncs = 0
+
+    def reset_timer(self, condition=None):
+        """
+        Resets the device's timer. If condition is given, the reset is also
+        the anchor of a trial of that condition.
+        """
+        before = time.perf_counter()
+        self.device.reset_timer()
+        if not self.__sync_clock():
+            self.__timer_zero = (before + time.perf_counter()) / 2.0
+        # Anchors from before the reset are on the old time base
+        self.__expire_all()
+
+        if condition is not None:
+            self.anchor(condition, 0)
+
+    def __sync_clock(self):
+        # Returns False on XID 1 devices, whose timer can't be queried
+        clock = sync_device_clock(self.device)
+        if clock is None:
+            return False
+
+        (self.__timer_zero, self.__sync_error_ms) = clock
+        self.__synced_at = time.perf_counter()
+        self.__syncs += 1
+        return True
+
+    def clock_status(self):
+        """
+        Returns a dict with the number of clock 'syncs' made, the seconds
+        since the last one ('age', None if there was none) and the error
+        bound it left in ms ('error_ms')
+        """
+        age = None
+        if self.__synced_at is not None:
+            age = time.perf_counter() - self.__synced_at
+
+        return {'syncs': self.__syncs,
+                'age': age,
+                'error_ms': self.__sync_error_ms}
+
+    def device_time(self):
+        """
+        The device's timer in miliseconds, estimated from the host clock if
+        the timer was reset through this engine and queried otherwise.
+        """
+        if self.__timer_zero is not None:
+            return (time.perf_counter() - self.__timer_zero) * 1000.0
+
+        return self.device.query_timer()
+
+    def marker(self, condition, lines=None, bitmask=None):
+        """
+        Raises the given output lines (see XidDevice.activate_line()) and
+        anchors a trial of condition at the time they were raised
+        """
+        if lines is not None or bitmask is not None:
+            self.device.activate_line(lines=lines, bitmask=bitmask)
+
+        self.anchor(condition, self.device_time() + self.marker_offset_ms)
+
+    def anchor(self, condition, device_time):
+        """
+        Anchors a trial of condition at device_time (miliseconds)
+        """
+        self.__anchors.append((device_time, condition))
+
+    def process(self, response):
+        """
+        Pairs a response with the open anchor it follows, if any. Returns
+        (condition, rt) if it gave a reaction time, otherwise None.
+        """
+        if not self.accept(response):
+            return None
+
+        response_time = response['time']
+        self.expire(response_time)
+
+        # The response answers the latest anchor before it; earlier open
+        # anchors were superseded by it without a response
+        earlier = [anchor for anchor in self.__anchors
+                   if anchor[0] <= response_time]
+        if not earlier:
+            self.unpaired += 1
+            return None
+
+        paired = max(earlier, key=lambda anchor: anchor[0])
+        for anchor in earlier:
+            if anchor is not paired:
+                self.__stats(anchor[1])
+                self.misses[anchor[1]] += 1
+        self.__anchors = collections.deque(
+            anchor for anchor in self.__anchors if anchor[0] > response_time)
+
+        (anchor_time, condition) = paired
+        rt = response_time - anchor_time
+        self.__stats(condition).add(rt)
+        return (condition, rt)
+
+    def expire(self, device_time=None):
+        """
+        Closes the anchors whose window ended before device_time (now if not
+        given), counting them as misses
+        """
+        if device_time is None:
+            device_time = self.device_time()
+
+        while self.__anchors and \
+                device_time - self.__anchors[0][0] > self.window_ms:
+            (_, condition) = self.__anchors.popleft()
+            self.__stats(condition)
+            self.misses[condition] += 1
+
+    def __expire_all(self):
+        while self.__anchors:
+            (_, condition) = self.__anchors.popleft()
+            self.misses[condition] += 1
+
+    def __stats(self, condition):
+        if condition not in self.stats:
+            self.stats[condition] = RunningStats(self.quantiles)
+        return self.stats[condition]
+
+    def update(self, timeout=0):
+        """
+        Processes the responses waiting on the device, waiting up to timeout
+        miliseconds for the first one (and for the open anchors to be paired
+        if timeout is longer). Lines the clocks up again first if
+        resync_interval has passed. Returns the list of (condition, rt)
+        found.
+        """
+        results = []
+        if self.__synced_at is not None and \
+                self.resync_interval is not None and \
+                time.perf_counter() - self.__synced_at >= \
+                self.resync_interval:
+            self.__sync_clock()
+        deadline = time.perf_counter() + timeout / 1000.0
+
+        while True:
+            # At least one short read, so bytes in the driver get parsed
+            remaining = max(1, int((deadline - time.perf_counter()) * 1000))
+            if results and not self.__anchors:
+                remaining = 1
+            response = self.device.wait_for_response(remaining)
+            if response is None:
+                break
+
+            result = self.process(response)
+            if result is not None:
+                results.append(result)
+
+        if self.__timer_zero is not None:
+            self.expire()
+
+        return results
+
+    def open_anchors(self):
+        return len(self.__anchors)
+
+    def summary(self):
+        """
+        Returns {condition: statistics dict} with the RunningStats of each
+        condition plus its 'misses'
+        """
+        summary = {}
+        for (condition, stats) in self.stats.items():
+            summary[condition] = stats.to_dict()
+            summary[condition]['misses'] = self.misses[condition]
+
+        return summary
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+Device server: one process owns an XID device and shares it with others.
+
+Only one process can open an FTDI device. The server process opens it, polls
+for responses and writes them into a shared memory ring buffer that any
+number of local processes read without copying through a socket or
+unpickling. Event markers and other commands are sent to the server over a
+Unix domain socket.
+
+Example, in the process that starts the server:
+
+    from pyxid2.server import start_device_server
+    server = start_device_server('xid-ring', '/tmp/xid.sock')
+
+in the stimulus process:
+
+    from pyxid2.server import DeviceClient
+    dev = DeviceClient('/tmp/xid.sock')
+    dev.activate_line(lines=1)
+
+and in the logging process:
+
+    from pyxid2.server import EventRingReader
+    ring = EventRingReader('xid-ring')
+    for (seq, port, key, pressed, time, host_time) in ring.read_new():
+        ...
+"""
+import multiprocessing
+import pickle
+import struct
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from multiprocessing import shared_memory
+
+from .writer import WriteHandle
+
+# Header: magic, capacity, sequence number of the last event written.
+_HEADER = struct.Struct('<4sIQ')
+_MAGIC = b'XIDR'
+# Slot: sequence number, port, key, pressed, device time, host time.
+_SLOT = struct.Struct('<QBbBxId')
+
+# The XidDevice methods clients may call: markers, settings, the timer and
+# the pulse table. Responses are the server's to read (into the ring), so
+# nothing that reads, drops or filters them is here, and neither is
+# anything that closes or reopens the device.
+CLIENT_METHODS = frozenset([
+    'activate_line', 'clear_line', 'set_lines', 'clear_all_lines',
+    'send_marker_burst', 'commit_lines', 'set_line_coalescing_window',
+    'start_output_writer', 'stop_output_writer',
+    'reset_timer', 'query_timer',
+    'get_pulse_duration', 'set_pulse_duration',
+    'get_single_shot', 'set_single_shot',
+    'get_signal_filter', 'set_signal_filter',
+    'get_enable_digital_output', 'set_enable_digital_output',
+    'get_enable_usb_output', 'set_enable_usb_output',
+    'is_input_paused', 'pause_output',
+    'get_pulse_table_bitmask', 'set_pulse_table_bitmask',
+    'clear_pulse_table', 'add_pulse_table_entry', 'is_pulse_table_running',
+    'run_pulse_table', 'stop_pulse_table',
+    'read_config', 'apply_config', 'save_to_flash', 'reset_output_lines',
+    'invalidate_settings_cache', 'settings_cache_stats',
+    'is_response_device'])
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the block with the resource
+        # tracker, which would unlink it when this process exits.
+        shm = shared_memory.SharedMemory(name)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class EventRing(object):
+    """
+    Writer side of the shared memory event ring.
+
+    Events get sequence numbers starting at 1. Each slot carries the
+    sequence number of the event in it, set to 0 while the slot is being
+    written, so readers can tell when a slot was overwritten under them.
+    """
+    def __init__(self, name, capacity=65536):
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(
+            name, create=True, size=_HEADER.size + capacity * _SLOT.size)
+        self.__seq = 0
+        _HEADER.pack_into(self.shm.buf, 0, _MAGIC, capacity, 0)
+
+    def append(self, port, key, pressed, time, host_time):
+        self.__seq += 1
+        offset = _HEADER.size + ((self.__seq - 1) % self.capacity) * _SLOT.size
+        buf = self.shm.buf
+
+        struct.pack_into('<Q', buf, offset, 0)
+        _SLOT.pack_into(buf, offset, 0, port, key, pressed, time, host_time)
+        struct.pack_into('<Q', buf, offset, self.__seq)
+        _HEADER.pack_into(buf, 0, _MAGIC, self.capacity, self.__seq)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class EventRingReader(object):
+    """
+    Reader side of the shared memory event ring. Each reader keeps its own
+    position; events overwritten before they were read are counted in lost.
+    """
+    def __init__(self, name, from_start=False):
+        self.shm = _attach(name)
+        (magic, self.capacity, last_seq) = _HEADER.unpack_from(self.shm.buf,
+                                                               0)
+        if magic != _MAGIC:
+            raise ValueError('%s is not a pyxid2 event ring' % name)
+
+        self.next_seq = 1 if from_start else last_seq + 1
+        self.lost = 0
+
+    def last_seq(self):
+        return _HEADER.unpack_from(self.shm.buf, 0)[2]
+
+    def read_new(self):
+        """
+        Returns a list of (seq, port, key, pressed, time, host_time) tuples
+        for the events written since the last call. time is the device
+        timestamp in miliseconds, host_time the server's time.time() when
+        the event was received.
+        """
+        buf = self.shm.buf
+        last_seq = self.last_seq()
+        events = []
+
+        if last_seq - self.next_seq >= self.capacity:
+            skipped = last_seq - self.capacity + 1 - self.next_seq
+            self.lost += skipped
+            self.next_seq += skipped
+
+        while self.next_seq <= last_seq:
+            offset = _HEADER.size + \
+                ((self.next_seq - 1) % self.capacity) * _SLOT.size
+            event = _SLOT.unpack_from(buf, offset)
+            if event[0] != self.next_seq or \
+                    struct.unpack_from('<Q', buf, offset)[0] != self.next_seq:
+                # Overwritten by a newer event while we were behind
+                self.lost += 1
+            else:
+                events.append(event)
+            self.next_seq += 1
+
+        return events
+
+    def close(self):
+        self.shm.close()
+
+
+class DeviceServer(object):
+    """
+    Owns an XidDevice in the current process: polls it into an EventRing
+    and serves command requests on a Unix domain socket at address.
+    """
+    POLL_TIMEOUT_MS = 50
+
+    def __init__(self, device, ring_name, address, capacity=65536,
+                 authkey=None):
+        self.device = device
+        self.ring = EventRing(ring_name, capacity)
+        self.listener = Listener(address, 'AF_UNIX', authkey=authkey)
+        self.__running = False
+
+    def serve_forever(self, ready=None):
+        self.__running = True
+        accept_thread = threading.Thread(target=self.__accept_clients)
+        accept_thread.daemon = True
+        accept_thread.start()
+
+        if ready is not None:
+            ready.set()
+
+        try:
+            while self.__running:
+                response = self.device.wait_for_response(self.POLL_TIMEOUT_MS)
+                if response is not None:
+                    self.ring.append(response['port'], response['key'],
+                                     response['pressed'], response['time'],
+                                     time.time())
+        finally:
+            self.listener.close()
+            self.ring.close()
+
+    def shutdown(self):
+        self.__running = False
+
+    def __accept_clients(self):
+        while self.__running:
+            try:
+                connection = self.listener.accept()
+            except (OSError, EOFError):
+                break
+            client_thread = threading.Thread(target=self.__serve_client,
+                                             args=(connection,))
+            client_thread.daemon = True
+            client_thread.start()
+
+    def __serve_client(self, connection):
+        with connection:
+            while True:
+                try:
+                    (name, args, kwargs) = connection.recv()
+                except (EOFError, OSError):
+                    return
+
+                if name == 'shutdown':
+                    self.shutdown()
+                    self.__reply(connection, 'ok', None)
+                    return
+
+                try:
+                    if name not in CLIENT_METHODS:
+                        raise AttributeError('%s is not available to device '
+                                             'server clients' % name)
+                    result = getattr(self.device, name)(*args, **kwargs)
+                except Exception as exc:
+                    reply = ('error', exc)
+                else:
+                    if isinstance(result, WriteHandle):
+                        # Queued on the output writer; the handle can't be
+                        # waited on from another process
+                        result = None
+                    reply = ('ok', result)
+
+                try:
+                    self.__reply(connection, *reply)
+                except (EOFError, OSError):
+                    return
+
+    def __reply(self, connection, status, value):
+        try:
+            data = pickle.dumps((status, value))
+        except Exception as exc:
+            data = pickle.dumps(('error', TypeError(
+                'The reply could not be sent to the client: %s' % exc)))
+
+        connection.send_bytes(data)
+
+
+def serve_device(ring_name, address, device_index=0, capacity=65536,
+                 authkey=None, profile=None, ready=None):
+    """
+    Opens the XID device at device_index and serves it until a client
+    calls shutdown(). Meant to be the target of a server process.
+    """
+    import pyxid2
+
+    devices = pyxid2.get_xid_devices(profile)
+    if device_index >= len(devices):
+        raise ValueError('No XID device at index %d' % device_index)
+
+    try:
+        server = DeviceServer(devices[device_index], ring_name, address,
+                              capacity, authkey)
+        server.serve_forever(ready)
+    finally:
+        for device in devices:
+            device.close()
+
+
+def start_device_server(ring_name, address, device_index=0, capacity=65536,
+                        authkey=None, profile=None, timeout=30):
+    """
+    Starts serve_device() in a new process and waits until it is ready.
+    Returns the multiprocessing.Process.
+    """
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(
+        target=serve_device,
+        args=(ring_name, address, device_index, capacity, authkey, profile,
+              ready))
+    process.daemon = True
+    process.start()
+
+    if not ready.wait(timeout):
+        process.terminate()
+        raise RuntimeError('The XID device server did not start')
+
+    return process
+
+
+class DeviceClient(object):
+    """
+    Sends commands to a DeviceServer. Device methods can be called on the
+    client directly, e.g. client.activate_line(lines=1); responses are read
+    from the server's EventRing instead. Methods that return a
+    writer.WriteHandle (with the device's output writer on) return None.
+    """
+    def __init__(self, address, authkey=None):
+        self.__connection = Client(address, 'AF_UNIX', authkey=authkey)
+        self.__lock = threading.Lock()
+
+    def call(self, name, *args, **kwargs):
+        with self.__lock:
+            self.__connection.send((name, args, kwargs))
+            (status, result) = self.__connection.recv()
+
+        if status == 'error':
+            raise result
+
+        return result
+
+    def shutdown(self):
+        """
+        Stops the server
+        """
+        self.call('shutdown')
+
+    def close(self):
+        self.__connection.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
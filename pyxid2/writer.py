@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import queue
+import threading
+import time
+
+
+class WriteHandle(object):
+    """
+    A write queued on a WriterThread.
+
+        queued:        time.perf_counter() time it was queued
+        sent:          time.perf_counter() time the driver accepted it, or
+                       None until then
+        bytes_written: what the driver reported, or None
+        error:         the exception raised by the write, if any
+    """
+    def __init__(self, command):
+        self.command = command
+        self.queued = time.perf_counter()
+        self.sent = None
+        self.bytes_written = None
+        self.error = None
+        self.__done = threading.Event()
+
+    def done(self):
+        return self.__done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Waits until the command was written. Returns False on timeout.
+        """
+        return self.__done.wait(timeout)
+
+    def _finish(self, bytes_written=None, error=None):
+        self.sent = time.perf_counter()
+        self.bytes_written = bytes_written
+        self.error = error
+        self.__done.set()
+
+    def __repr__(self):
+        if self.sent is None:
+            return '<WriteHandle %r queued>' % (self.command,)
+        return '<WriteHandle %r sent after %.3f ms>' % (
+            self.command, (self.sent - self.queued) * 1000.0)
+
+
+class WriterThread(object):
+    """
+    Writes queued commands in order on a thread of its own, so callers
+    don't wait for the driver (or for XID 1 inter-byte delays).
+
+    write is the function doing the actual write; it must only be called
+    from this thread while the writer runs. Send latency (time from
+    queueing to the driver accepting the command) is recorded in stats.
+    """
+    def __init__(self, write, stats):
+        self.__write = write
+        self.__stats = stats
+        self.__queue = queue.Queue()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def submit(self, command):
+        """
+        Queues command (bytes) and returns its WriteHandle
+        """
+        handle = WriteHandle(command)
+        self.__queue.put(handle)
+
+        return handle
+
+    def queue_depth(self):
+        return self.__queue.qsize()
+
+    def drain(self):
+        """
+        Waits until every command queued so far has been written
+        """
+        self.__queue.join()
+
+    def stop(self):
+        """
+        Writes the commands still queued, then ends the thread
+        """
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self):
+        while True:
+            handle = self.__queue.get()
+            if handle is None:
+                self.__queue.task_done()
+                return
+
+            try:
+                bytes_written = self.__write(handle.command)
+            except Exception as exc:
+                handle._finish(error=exc)
+                print('Pyxid writer thread failed to write %r. Err: %s' %
+                      (handle.command, exc))
+            else:
+                handle._finish(bytes_written)
+
+            self.__stats.observe_write_latency(
+                (handle.sent - handle.queued) * 1000.0)
+            self.__queue.task_done()
@@ -0,0 +1,42 @@
+'''
+This sample measures the end-to-end latency of event markers. Connect output
+line 1 of the device to one of its inputs (e.g. a StimTracker output to a
+StimTracker input), then run:
+
+    python latency_calibration.py [connection profile] [output file]
+
+Every marker is matched to the input it causes, and the difference between
+the time it was sent and the device's timestamp of the input is recorded.
+The results are saved as JSON; "offset_ms" in that file is the median
+latency.
+'''
+import sys
+
+import pyxid2
+from pyxid2.calibration import calibrate_marker_latency
+
+profile = sys.argv[1] if len(sys.argv) > 1 else 'low_latency'
+output = sys.argv[2] if len(sys.argv) > 2 else 'marker_latency.json'
+
+# get a list of all attached XID devices
+devices = pyxid2.get_xid_devices(profile)
+
+if devices:
+    print(devices)
+else:
+    print("No XID devices detected")
+    exit()
+
+dev = devices[0] # get the first device to use
+
+print("Using ", dev, "with the", profile, "profile")
+
+# Lines stay raised until they are lowered by the calibration
+dev.set_pulse_duration(0)
+
+result = calibrate_marker_latency(dev, count=2000, lines=1)
+
+print(result.summary())
+
+result.save(output)
+print("Saved to", output)
@@ -31,10 +31,12 @@ print(dev)
 dev.reset_timer()
 
 print ("Press a key!")
-while not dev.has_response():
-    dev.poll_for_response()
+# wait_for_response() blocks until a response arrives (or the optional
+# timeout in miliseconds expires) without keeping the CPU busy. The older
+# pattern of calling poll_for_response() in a loop until has_response()
+# returns True still works.
+response = dev.wait_for_response()
 
-response = dev.get_next_response()
 # You can filter out key releases by simply ignoring them
 if response['pressed'] == True:
     # Process response as desired
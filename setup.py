@@ -11,6 +11,7 @@ setup(
     version = "1.0.8",
     packages = find_packages(),
     install_requires = ["ftd2xx>=1.3.8"],
+    extras_require = {"columnar": ["pandas", "pyarrow"]},
     author = "Eugene Matsak",
     author_email = "developers@cedrus.com",
     maintainer = "Cedrus Corporation",